@@ -0,0 +1,28 @@
+"""Creates the database indexes and verifies that no query falls back to a collection scan.
+
+Usage: python check_indexes.py
+Exits with status 1 if any query shape in modules/database.py is planned as a COLLSCAN, or if its
+plan could not be read.
+"""
+import asyncio
+import sys
+
+from modules import database
+
+
+async def main() -> int:
+    await database.ensure_indexes()
+    plans = await database.explain_queries()
+
+    failed = False
+    for name, stages in plans.items():
+        # an explain format we can't read must not pass as an index scan
+        bad_plan = not stages or "COLLSCAN" in stages
+        failed = failed or bad_plan
+        print(f"{'FAIL' if bad_plan else 'ok  '} {name}: {' <- '.join(stages) or 'no plan stages found'}")
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -1,15 +1,38 @@
+import asyncio
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
+from modules import database
+
 from routes.vision import router as vision_router
 from routes.conversation import router as conversation_router
 from routes.user import router as user_router
 from routes.tts import router as tts_router
+from routes.metrics import router as metrics_router
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await database.ensure_indexes()
+    database.conversation_buffer.start()
+    database.visual_buffer.start()
+    database.registry_queue.start()
+    database.dedup_queue.start()
+    compactor = asyncio.create_task(database.run_compactor())
+    yield
+    compactor.cancel()
+    # pending inserts are written before the dedup worker drains
+    await database.conversation_buffer.stop()
+    await database.visual_buffer.stop()
+    await database.registry_queue.stop()
+    await database.dedup_queue.stop()
 
 app = FastAPI(
     title="SFHacks API",
     description="API for SFHacks Project",
-    version="0.1.0"
+    version="0.1.0",
+    lifespan=lifespan
 )
 
 app.add_middleware(
@@ -24,6 +47,7 @@ app.include_router(user_router, prefix="/api", tags=["user"])
 app.include_router(vision_router, prefix="/api", tags=["vision"])
 app.include_router(conversation_router, prefix="/api", tags=["conversation"])
 app.include_router(tts_router, prefix="/api", tags=["tts"])
+app.include_router(metrics_router, prefix="/api", tags=["metrics"])
 
 @app.get("/")
 async def root():
@@ -0,0 +1,18 @@
+"""Adds the fields newer code relies on to visual contexts saved before they existed.
+
+Usage: python migrate_scene_index.py
+Run once after deploying, from a single machine. It scans the whole visual collection, so it is
+not part of the app's startup.
+"""
+import asyncio
+
+from modules import database
+
+
+async def main():
+    updated = await database.backfill_scene_index()
+    print(f"Updated {updated} visual contexts and registry entries")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,17 +1,9 @@
 import asyncio
-import os
 from difflib import SequenceMatcher
-from dotenv import load_dotenv
-import spacy
+import numpy as np
 from concurrent.futures import ThreadPoolExecutor
 
-from numpy.ma.extras import average
-
-load_dotenv()
-
-parent_dir = os.path.dirname((os.path.dirname(__file__)))
-model_dir = os.path.join(parent_dir, "static", "en_core_web_md-3.8.0")
-nlp = spacy.load(model_dir, disable=["ner", "parser", "tagger"])
+from modules import vectors
 
 executor = ThreadPoolExecutor()
 
@@ -20,65 +12,122 @@ LOCATION_WEIGHT = 0.2
 COLOR_WEIGHT = 0.2
 DESCRIPTION_WEIGHT = 0.2
 
-# Preprocesses items in a document by creating 'doc' fields for the 'name', 'location', and 'description'
-# These fields store the processed spaCy document objects for faster similarity comparison.
-async def _prepare_doc_items(items):
-    for item in items:
-        for key in ["name", "location", "description"]:
-            item[f"{key}_doc"] = nlp(item[key])
-    return items
+EMBEDDING_FIELDS = ["name", "location", "description"]
+
+# Computes the unit-length name, location and description vectors of every item as (N, dim) float32 matrices.
+# All fields go to the vectorizer as one batch. Rows with a zero vector (no known words) stay zero,
+# matching Doc.similarity returning 0.0 for them.
+async def _field_matrices(items):
+    texts = [item[key] for key in EMBEDDING_FIELDS for item in items]
+    matrix = await vectors.vectorize(texts)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    matrix = np.divide(matrix, norms, out=np.zeros_like(matrix), where=norms > 0)
+
+    n = len(items)
+    return {key: matrix[i * n:(i + 1) * n] for i, key in enumerate(EMBEDDING_FIELDS)}
+
+async def embed_items(items) -> dict:
+    """Computes the item vectors of a visual context so they can be stored alongside it.
+
+    Args:
+        items: The items of a visual context.
+
+    Returns:
+        A dictionary with the model tag, the vector width, and one float16 byte string per field
+        holding the (len(items), dim) matrix of normalized vectors.
+    """
+    embeddings = {"model": vectors.MODEL_TAG, "dim": vectors.VECTOR_DIM, "count": len(items)}
+    for key, matrix in (await _field_matrices(items)).items():
+        embeddings[key] = matrix.astype(np.float16).tobytes()
+    return embeddings
+
+# Decodes stored embeddings back into float32 matrices, or returns None if they are missing,
+# were written by another model, or don't match the document's items anymore.
+def _load_embeddings(doc):
+    embeddings = doc.get("embeddings")
+    items = doc["visual_context"]["items"]
+    if not embeddings or embeddings.get("model") != vectors.MODEL_TAG or embeddings.get("count") != len(items):
+        return None
+
+    dim = embeddings["dim"]
+    return {
+        key: np.frombuffer(embeddings[key], dtype=np.float16).reshape(len(items), dim).astype(np.float32)
+        for key in EMBEDDING_FIELDS
+    }
+
+# Prepares a document for comparison: the item colors plus one normalized vector matrix per field.
+# Persisted embeddings are used when available so stored scenes never go through spaCy again.
+async def prepare_doc(doc):
+    items = doc["visual_context"]["items"]
+    prepared = _load_embeddings(doc)
+    if prepared is None:
+        prepared = await _field_matrices(items)
+    prepared["colors"] = [item["color"] for item in items]
+    return prepared
 
 # Quickly computes a similarity score for the 'color' field using string matching
 # This function is used as a fallback for color comparison where semantic meaning isn't important.
 def fast_similarity(a, b):
     return SequenceMatcher(None, a.lower(), b.lower()).ratio()
 
-# Compares the four key attributes ('name', 'location', 'color', 'description') between two objects
-# Each attribute has a weighted contribution to the final similarity score.
-def compare_objects(obj1, obj2):
-    name_sim = obj1["name_doc"].similarity(obj2["name_doc"])
-    loc_sim = obj1["location_doc"].similarity(obj2["location_doc"])
-    color_sim = fast_similarity(obj1["color"], obj2["color"])
-    desc_sim = obj1["description_doc"].similarity(obj2["description_doc"])
+# Builds the (N, M) color similarity matrix. Colors repeat a lot within a scene ("white", "black"),
+# so SequenceMatcher only runs once per distinct pair of strings.
+def _color_matrix(colors1, colors2):
+    colors1 = [color.lower() for color in colors1]
+    colors2 = [color.lower() for color in colors2]
+    unique1 = {color: i for i, color in enumerate(dict.fromkeys(colors1))}
+    unique2 = {color: j for j, color in enumerate(dict.fromkeys(colors2))}
+
+    unique_scores = np.empty((len(unique1), len(unique2)), dtype=np.float32)
+    for color1, i in unique1.items():
+        for color2, j in unique2.items():
+            unique_scores[i, j] = SequenceMatcher(None, color1, color2).ratio()
+
+    rows = [unique1[color] for color in colors1]
+    cols = [unique2[color] for color in colors2]
+    return unique_scores[np.ix_(rows, cols)]
+
+# Computes the weighted (N, M) similarity matrix between every object of two prepared documents.
+# Cosine similarity of the name, location and description vectors is one matmul per field.
+def similarity_matrix(prepared1, prepared2):
+    scores = COLOR_WEIGHT * _color_matrix(prepared1["colors"], prepared2["colors"])
+    for key, weight in (("name", NAME_WEIGHT), ("location", LOCATION_WEIGHT), ("description", DESCRIPTION_WEIGHT)):
+        scores += weight * (prepared1[key] @ prepared2[key].T)
+    return scores
+
+# Scores a document pair: each object of the first document by its best match in the second, averaged.
+# With reverse=True the second document's objects are scored against the first instead,
+# which is the same similarity matrix read by columns.
+def _score_pair(prepared1, prepared2, reverse=False):
+    n, m = len(prepared1["colors"]), len(prepared2["colors"])
 
+    # figure this out later
+    if n < 2 and m < 2: # if both are near empty of items
+        return 1.00 # we should do description & image_location comparison only
 
-    return (
-        name_sim * NAME_WEIGHT +
-        loc_sim * LOCATION_WEIGHT +
-        color_sim * COLOR_WEIGHT +
-        desc_sim * DESCRIPTION_WEIGHT
-    )
+    if not n or not m:
+        return 0.0
 
-# Synchronously compares an object from items1 to all objects in items2 and returns the best similarity score
-def _compare_objects_sync(obj1, items2):
-    # For each object in items2, compute the similarity score with obj1 and return the highest score
-    return max(compare_objects(obj1, obj2) for obj2 in items2)
+    matrix = similarity_matrix(prepared1, prepared2)
+    return float(matrix.max(axis=0 if reverse else 1).mean())
 
-# Asynchronously compares two documents (doc1 and doc2) by processing their items and calculating similarity scores
-# This function uses ThreadPoolExecutor to perform the object comparisons in parallel threads.
-# TK forgot to check image_location & description
-async def compare_docs(doc1, doc2, threshold=0.75):
-    items1 = await _prepare_doc_items(doc1["visual_context"]["items"])
-    items2 = await _prepare_doc_items(doc2["visual_context"]["items"])
+def _score_many(prepared, prepared_candidates, reverse):
+    return [_score_pair(prepared, candidate, reverse) for candidate in prepared_candidates]
 
-    # figure this out later
-    if len(items1) < 2 and len(items2) < 2: # if both are near empty of items
-        return 1.00 # we should do description & image_location comparison only
+# Compares one document against many candidates in a single pass.
+# Each document is prepared once, and all the scoring runs in a single executor call to keep it off the event loop.
+# Scores are doc's objects against each candidate, or each candidate's objects against doc with reverse=True.
+# TK forgot to check image_location & description
+async def compare_doc_to_many(doc, candidates, reverse=False) -> list[float]:
+    prepared = await prepare_doc(doc)
+    prepared_candidates = [await prepare_doc(candidate) for candidate in candidates]
 
     loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, _score_many, prepared, prepared_candidates, reverse)
 
-    # Schedule all comparisons in parallel threads
-    tasks = [
-        loop.run_in_executor(executor, _compare_objects_sync, obj1, items2)
-        for obj1 in items1
-    ]
-
-    scores = await asyncio.gather(*tasks)
-    return average(scores)
+# Asynchronously compares two documents (doc1 and doc2) by processing their items and calculating similarity scores
+async def compare_docs(doc1, doc2, threshold=0.75):
+    scores = await compare_doc_to_many(doc1, [doc2])
+    return scores[0]
     # matched = sum(score >= threshold for score in scores)
     # return matched / max(len(items1), len(items2))
-
-
-
-
-
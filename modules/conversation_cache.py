@@ -0,0 +1,132 @@
+import os
+import time
+from collections import OrderedDict, deque
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# How many of the newest turns are kept per user
+MAX_TURNS = int(os.getenv('CONVERSATION_CACHE_TURNS', 20))
+MAX_USERS = int(os.getenv('CONVERSATION_CACHE_MAX_USERS', 10000))
+MAX_BYTES = int(os.getenv('CONVERSATION_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+# Entries are reloaded from Mongo after this many seconds, which bounds how stale a worker can be
+# when another uvicorn worker wrote to the same conversation
+MAX_AGE = float(os.getenv('CONVERSATION_CACHE_MAX_AGE', 300))
+
+# Rough per-message bookkeeping overhead on top of the content itself
+_MESSAGE_OVERHEAD = 200
+
+
+def _message_size(message: dict) -> int:
+    return len(message["content"]) + _MESSAGE_OVERHEAD
+
+
+class ConversationCache:
+    """An in-process cache of each user's most recent conversation turns.
+
+    Every user has a ring buffer of their newest MAX_TURNS messages that save_message writes
+    through to. Idle users are evicted least recently used first once MAX_USERS or MAX_BYTES
+    is exceeded.
+    """
+
+    def __init__(self, max_turns: int, max_users: int, max_bytes: int, max_age: float):
+        self.max_turns = max_turns
+        self.max_users = max_users
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+
+        self._users = OrderedDict()  # user_id -> {"messages": deque, "size": int, "loaded_at": float}
+        self._size = 0
+        # Loads in flight per user, and how many writes happened to that user while they ran
+        self._loads = {}
+        self._writes = {}
+
+    def get(self, user_id: str):
+        """Returns the cached turns of a user, oldest first, or None on a miss."""
+        entry = self._users.get(user_id)
+        if entry is None or time.monotonic() - entry["loaded_at"] > self.max_age:
+            if entry is not None:
+                self._remove(user_id)
+            self.misses += 1
+            return None
+
+        self._users.move_to_end(user_id)
+        self.hits += 1
+        return list(entry["messages"])
+
+    def begin_load(self, user_id: str) -> int:
+        """Marks the start of a reload from Mongo. Returns the token to pass to finish_load."""
+        self._loads[user_id] = self._loads.get(user_id, 0) + 1
+        return self._writes.setdefault(user_id, 0)
+
+    def finish_load(self, user_id: str, token: int, messages: list[dict] = None):
+        """Caches reloaded turns, unless the load failed or a message was written while they were being read."""
+        if messages is not None and self._writes.get(user_id) == token and user_id not in self._users:
+            self._store(user_id, messages)
+
+        self._loads[user_id] -= 1
+        if not self._loads[user_id]:
+            del self._loads[user_id]
+            del self._writes[user_id]
+
+    def append(self, user_id: str, message: dict):
+        """Writes a saved message through to the user's cached turns."""
+        if user_id in self._loads:
+            self._writes[user_id] += 1
+
+        entry = self._users.get(user_id)
+        if entry is None:
+            # The next read reloads from Mongo, which already has this message
+            return
+
+        messages = entry["messages"]
+        if len(messages) == messages.maxlen:
+            dropped = _message_size(messages[0])
+            entry["size"] -= dropped
+            self._size -= dropped
+        messages.append(message)
+        entry["size"] += _message_size(message)
+        self._size += _message_size(message)
+        self._users.move_to_end(user_id)
+        self._evict()
+
+    def clear(self, user_id: str):
+        if user_id in self._loads:
+            self._writes[user_id] += 1
+        self._remove(user_id)
+
+    def _store(self, user_id: str, messages: list[dict]):
+        size = sum(_message_size(message) for message in messages)
+        self._users[user_id] = {
+            "messages": deque(messages, maxlen=self.max_turns),
+            "size": size,
+            "loaded_at": time.monotonic(),
+        }
+        self._size += size
+        self._evict()
+
+    def _remove(self, user_id: str):
+        entry = self._users.pop(user_id, None)
+        if entry is not None:
+            self._size -= entry["size"]
+
+    def _evict(self):
+        while self._users and (len(self._users) > self.max_users or self._size > self.max_bytes):
+            _, entry = self._users.popitem(last=False)
+            self._size -= entry["size"]
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "users": len(self._users),
+            "bytes": self._size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+cache = ConversationCache(MAX_TURNS, MAX_USERS, MAX_BYTES, MAX_AGE)
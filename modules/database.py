@@ -1,13 +1,21 @@
 import asyncio
 import datetime
 import os
+import socket
+import time
+import uuid
 
 from bson import ObjectId
 from dotenv import load_dotenv
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import DuplicateKeyError
 
-from modules import comparisons
-from utils.common import calculate_relative_timestamp, run_sync
+from modules import comparisons, conversation_cache, history, lsh, registry, retention, search
+from utils import metrics
+from utils.coalescing_queue import CoalescingQueue
+from utils.write_buffer import WriteBuffer
+from utils.common import calculate_relative_timestamp
 
 load_dotenv()
 
@@ -16,54 +24,197 @@ client = AsyncIOMotorClient(os.getenv('MONGODB_URI'))
 database = client[os.getenv('DATABASE_NAME')]
 visual_collection = database[os.getenv('VISUAL_COLLECTION_NAME')]
 conversation_collection = database[os.getenv('CONVERSATION_COLLECTION_NAME')]
+object_collection = database[os.getenv('OBJECT_COLLECTION_NAME', 'objects')]
+
+# How many earlier scenes each new scene is checked against for duplicates
+DEDUP_WINDOW = 4
+# Most new scenes of one user checked in a single dedup pass
+DEDUP_MAX_SCENES_PER_PASS = 20
+# Most registry entries considered when matching the items of a new scene
+REGISTRY_CANDIDATES = 500
+# Most scenes of one user waiting for the registry worker
+REGISTRY_MAX_PENDING_SCENES = 20
+# How many keyword matches are ranked per search
+SEARCH_CANDIDATES = 200
+# How many of the newest scenes are considered when rendering the visual history
+HISTORY_CANDIDATES = int(os.getenv('HISTORY_CANDIDATES', 200))
+# Scenes sharing an LSH band are only compared in full if their estimated Jaccard similarity reaches this
+LSH_MIN_SIMILARITY = float(os.getenv('LSH_MIN_SIMILARITY', 0.3))
+
+# Inserts are batched: a flush happens once this many documents wait or this many seconds after the first
+WRITE_BUFFER_MAX_BATCH = int(os.getenv('WRITE_BUFFER_MAX_BATCH', 100))
+WRITE_BUFFER_MAX_DELAY = float(os.getenv('WRITE_BUFFER_MAX_DELAY', 0.05))
+
+conversation_buffer = WriteBuffer("conversation_writes", conversation_collection, WRITE_BUFFER_MAX_BATCH, WRITE_BUFFER_MAX_DELAY)
+visual_buffer = WriteBuffer("visual_writes", visual_collection, WRITE_BUFFER_MAX_BATCH, WRITE_BUFFER_MAX_DELAY)
+
+
+async def ensure_indexes():
+    """Creates the indexes the queries in this module rely on. Safe to run on every startup."""
+    await visual_collection.create_index([("user_id", 1), ("timestamp", -1)], name="user_id_timestamp")
+    await conversation_collection.create_index([("user_id", 1), ("timestamp", -1)], name="user_id_timestamp")
+    await visual_collection.create_index(
+        [("user_id", 1), ("search_terms", 1), ("timestamp", -1)], name="user_id_search_terms_timestamp")
+    await visual_collection.create_index([("user_id", 1), ("lsh_bands", 1)], name="user_id_lsh_bands")
+    await object_collection.create_index([("user_id", 1), ("terms", 1)], name="user_id_terms")
+    # Tiered retention: old scenes are found by age for compaction, merged into one summary per
+    # location, and everything is removed once its expires_at date has passed
+    await visual_collection.create_index([("timestamp", 1)], name="timestamp")
+    await visual_collection.create_index(
+        [("user_id", 1), ("summary_key", 1)], name="user_id_summary_key", unique=True,
+        partialFilterExpression={"summary_key": {"$exists": True}})
+    await visual_collection.create_index([("expires_at", 1)], name="expires_at", expireAfterSeconds=0)
+    # Registry entries expire with the last sighting of their object, and follow their scene into its summary
+    await object_collection.create_index([("expires_at", 1)], name="expires_at", expireAfterSeconds=0)
+    await object_collection.create_index([("user_id", 1), ("scene_id", 1)], name="user_id_scene_id")
+
+
+# Every query shape this module runs, as (name, collection, filter, sort, limit).
+# check_indexes.py explains each of them to make sure none falls back to a collection scan. The one
+# exception is backfill_scene_index, a one-off migration that scans on purpose.
+def _query_shapes(user_id: str) -> list[tuple]:
+    return [
+        ("fetch_history", visual_collection, {"user_id": user_id}, [("timestamp", -1)], HISTORY_CANDIDATES),
+        ("purge_recent_duplicates", visual_collection, {"user_id": user_id, "summary_key": {"$exists": False}},
+         [("timestamp", -1)], DEDUP_WINDOW + 1),
+        ("find_similar_entries", visual_collection,
+         {"user_id": user_id, "lsh_bands": {"$in": ["explain"]}, "summary_key": {"$exists": False}}, None, 1000),
+        ("search_visual_contexts", visual_collection, {"user_id": user_id, "search_terms": {"$in": ["explain"]}},
+         [("timestamp", -1)], SEARCH_CANDIDATES),
+        ("recent_visual_contexts", visual_collection, {"user_id": user_id}, [("timestamp", -1)], 5),
+        ("find_object", object_collection, {"user_id": user_id, "terms": {"$in": ["explain"]}}, None, REGISTRY_CANDIDATES),
+        ("get_conversation_history", conversation_collection, {"user_id": user_id}, [("timestamp", -1)], conversation_cache.MAX_TURNS),
+        ("compact_visual_history", visual_collection, _compaction_filter(0, 0), [("timestamp", 1)],
+         retention.COMPACTION_BATCH_SIZE),
+        ("location_summary", visual_collection, {"user_id": user_id, "summary_key": "explain"}, None, 1),
+        ("registry_scene_entries", object_collection, {"user_id": user_id, "scene_id": {"$in": ["explain"]}}, None, None),
+    ]
+
+# Deletes by filter, as (name, collection, filter)
+def _delete_shapes(user_id: str) -> list[tuple]:
+    return [
+        ("wipe_visual_history", visual_collection, {"user_id": user_id}),
+        ("wipe_conversation_history", conversation_collection, {"user_id": user_id}),
+        ("wipe_object_registry", object_collection, {"user_id": user_id}),
+    ]
+
+
+def _plan_stages(plan: dict) -> list[str]:
+    """Flattens an explained plan into its stage names, root first.
+
+    The slot-based engine nests the stage tree under queryPlan, and a sharded cluster reports the
+    winningPlan of every shard under shards.
+    """
+    stages = [plan["stage"]] if "stage" in plan else []
+    children = [
+        plan.get("queryPlan"),
+        plan.get("inputStage"),
+        *plan.get("inputStages", []),
+        *(shard.get("winningPlan") for shard in plan.get("shards", [])),
+    ]
+    for child in children:
+        if child:
+            stages.extend(_plan_stages(child))
+    return stages
+
+
+async def explain_queries(user_id: str = "explain") -> dict[str, list[str]]:
+    """Explains every query shape of this module.
+
+    Args:
+        user_id: The user ID to put in the filters.
 
+    Returns:
+        A dictionary mapping each query shape to the stages of its winning plan.
+    """
+    plans = {}
+    for name, collection, query, sort, limit in _query_shapes(user_id):
+        cursor = collection.find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        if limit:
+            cursor = cursor.limit(limit)
+        explanation = await cursor.explain()
+        plans[name] = _plan_stages(explanation["queryPlanner"]["winningPlan"])
+
+    for name, collection, query in _delete_shapes(user_id):
+        explanation = await database.command({
+            "explain": {"delete": collection.name, "deletes": [{"q": query, "limit": 0}]},
+            "verbosity": "queryPlanner"
+        })
+        plans[name] = _plan_stages(explanation["queryPlanner"]["winningPlan"])
 
-def fetch_history(user_id: str) -> list[dict]:
+    return plans
+
+
+async def fetch_history(user_id: str) -> str:
     """Fetches the history of what we saw in around the user along with the relative timestamp of when it occurred.
     Args:
         user_id: The ID of the user.
 
     Returns:
-        A list of dictionaries containing what items we saw in around the user along with the relative timestamp of when it occurred.
+        One block per scene, most recent first: a "[relative timestamp] location: description" line followed by
+        a "- name (color): location" line for every item last seen there.
     """
-    return run_sync(_fetch_history_async(user_id))
-
+    return await render_visual_history(user_id)
 
-async def _fetch_history_async(user_id: str) -> list[dict]:
-    cursor = visual_collection.find({"user_id": user_id})
 
-    history = []
-    async for document in cursor:
-        history.append({
-            "visual_context": document["visual_context"],
-            "relative_timestamp": calculate_relative_timestamp(document["timestamp"])
-        })
+async def render_visual_history(user_id: str, query: str = None) -> str:
+    """Renders the newest scenes of a user within the history token budget, scenes relevant to the query first."""
+    cursor = visual_collection.find(
+        {"user_id": user_id}, {"visual_context": 1, "timestamp": 1, "scene_count": 1, "first_seen": 1}
+    ).sort("timestamp", -1).limit(HISTORY_CANDIDATES)
+    documents = await cursor.to_list(length=HISTORY_CANDIDATES)
 
-    return history
+    text, stats = history.render(documents, search.tokenize(query) if query else None)
+    metrics.increment("fetch_history.tokens_saved", stats["tokens_saved"])
+    print(f"Rendered {stats['rendered']}/{stats['scenes']} scenes for {user_id} in ~{stats['tokens']} tokens "
+          f"(~{stats['tokens_saved']} saved)")
+    return text
 
 
-def get_conversation_history(user_id: str):
+async def get_conversation_history(user_id: str) -> list[dict]:
     """Retrieves the conversation history for a user.
     Args:
         user_id: The ID of the user.
 
     Returns:
-        A list of messages in the conversation history, ordered by timestamp.
+        A list of the most recent messages in the conversation history, ordered by timestamp.
     """
-    return run_sync(_get_conversation_history_async(user_id))
+    return await _get_conversation_history_async(user_id)
 
 
 async def _get_conversation_history_async(user_id: str) -> list[dict]:
-    cursor = conversation_collection.find({"user_id": user_id}).sort("timestamp", 1).limit(20)
+    cache = conversation_cache.cache
+    history = cache.get(user_id)
+    if history is not None:
+        return history
+
+    # Newest turns first so long conversations keep their end, then back to chronological order
+    token = cache.begin_load(user_id)
+    try:
+        # Messages still in the write buffer are taken before the query, so none is missed if it is
+        # written while the query runs
+        pending = conversation_buffer.pending(user_id)
+        cursor = conversation_collection.find({"user_id": user_id}).sort("timestamp", -1).limit(cache.max_turns)
+        documents = await cursor.to_list(length=cache.max_turns)
+
+        written = {document["_id"] for document in documents}
+        documents.extend(document for document in pending if document["_id"] not in written)
+        documents.sort(key=lambda document: document["timestamp"])
+
+        history = []
+        for document in documents[-cache.max_turns:]:
+            history.append({
+                "role": document["role"],
+                "content": document["content"]
+            })
+    except BaseException:
+        cache.finish_load(user_id, token)
+        raise
 
-    history = []
-    async for document in cursor:
-        history.append({
-            "role": document["role"],
-            "content": document["content"]
-        })
-
-    return history
+    cache.finish_load(user_id, token, history)
+    return list(history)
 
 
 async def save_message(user_id: str, role: str, content: str):
@@ -74,98 +225,228 @@ async def save_message(user_id: str, role: str, content: str):
         content: The content of the message.
     """
     document = {
+        "_id": ObjectId(),
         "user_id": user_id,
         "role": role,
         "content": content,
         "timestamp": datetime.datetime.now().timestamp()
     }
-    await conversation_collection.insert_one(document)
+    # written behind in a batch, readers see it through the cache and the buffer in the meantime
+    await conversation_buffer.add(document)
+    conversation_cache.cache.append(user_id, {"role": role, "content": content})
 
 
 async def save_visual_context(user_id, visual_context: dict):
+    timestamp = datetime.datetime.now().timestamp()
     document = {
+        # the id is known before the batched insert, for the registry and the recent frames cache
+        "_id": ObjectId(),
         "user_id": user_id,
         "visual_context": visual_context,
-        "timestamp": datetime.datetime.now().timestamp()  # unix timestamp
+        # item vectors are computed once here so later comparisons never re-parse this scene
+        "embeddings": await comparisons.embed_items(visual_context["items"]),
+        # inverted index entries for search_visual_contexts
+        "search_terms": search.index_terms(visual_context),
+        # MinHash signature and LSH bands for _find_similar_entries
+        **lsh.index_fields(visual_context),
+        "timestamp": timestamp,  # unix timestamp
+        "expires_at": retention.expires_at(timestamp)
     }
     # if len(document["visual_context"]["items"]) < 2:
-    result = await visual_collection.insert_one(document)
-    await _purge_on_insert(document)
-    print(result)
+    # raises DiscardedError if the user's history is wiped before the scene is written, and then
+    # nothing below may refer to it
+    await visual_buffer.write(document)
+    # the object registry is updated and duplicates are purged in the background, so neither can fail
+    # or slow down the upload. Bursts of frames from one user are handled in a single pass.
+    _queue_registry_update(document)
+    dedup_queue.submit(user_id)
+    print(f"Saved visual context {document['_id']}")
+    return document["_id"]
     # else:
     #     print("Insert Failed: No Items in Document")
 
 
+def _queue_registry_update(document: dict):
+    user_id = document["user_id"]
+    pending = _registry_pending.setdefault(user_id, [])
+    pending.append(document)
+    # the newest sightings matter most when a user's scenes pile up
+    del pending[:-REGISTRY_MAX_PENDING_SCENES]
+    if not registry_queue.submit(user_id):
+        _registry_pending.pop(user_id, None)
+
+
+async def _update_registry_for_user(user_id: str, count: int):
+    """Records the scenes of a user queued since the last pass in the object registry, oldest first."""
+    registry_pass = {"cancelled": False, "done": asyncio.get_running_loop().create_future()}
+    _registry_passes[user_id] = registry_pass
+    try:
+        for document in _registry_pending.pop(user_id, []):
+            if registry_pass["cancelled"]:
+                return
+            try:
+                await _update_object_registry(document)
+            except Exception as e:
+                print(f"Error updating the object registry with {document['_id']}: {str(e)}")
+    finally:
+        registry_pass["done"].set_result(None)
+        if _registry_passes.get(user_id) is registry_pass:
+            del _registry_passes[user_id]
+
+
+async def _cancel_registry_updates(user_id: str):
+    """Drops the queued registry updates of a user and waits out the one already running, if any."""
+    _registry_pending.pop(user_id, None)
+    registry_pass = _registry_passes.get(user_id)
+    if registry_pass is not None:
+        registry_pass["cancelled"] = True
+        await asyncio.shield(registry_pass["done"])
+
+
+async def _update_object_registry(document: dict):
+    """Records the items of a newly saved scene as the latest sightings of the user's objects."""
+    user_id = document["user_id"]
+    visual_context = document["visual_context"]
+    items = visual_context["items"]
+    if not items:
+        return
+
+    terms = sorted({term for item in items for term in registry.object_terms(item["name"])})
+    entries = await object_collection.find(
+        {"user_id": user_id, "terms": {"$in": terms}},
+        {"key": 1, "name_vector": 1}
+    ).to_list(length=REGISTRY_CANDIDATES)
+
+    # The name vectors were already computed for the scene's embeddings
+    name_vectors = (await comparisons.prepare_doc(document))["name"]
+    matches = registry.match_items(items, name_vectors, entries)
+
+    operations = []
+    for item, vector, entry in zip(items, name_vectors, matches):
+        fields = registry.entry_fields(item, visual_context, document["_id"], document["timestamp"], vector)
+        # every sighting pushes the expiry back, like the scene's own
+        fields["expires_at"] = retention.expires_at(document["timestamp"])
+        item_terms = registry.object_terms(item["name"])
+        if entry is None:
+            operations.append(InsertOne({
+                "user_id": user_id,
+                **fields,
+                "terms": item_terms,
+                "first_seen": document["timestamp"],
+                "sightings": 1
+            }))
+        else:
+            operations.append(UpdateOne(
+                {"_id": entry["_id"]},
+                {"$set": fields, "$addToSet": {"terms": {"$each": item_terms}}, "$inc": {"sightings": 1}}
+            ))
+
+    await object_collection.bulk_write(operations, ordered=False)
+
+
+async def find_object(user_id: str, object_name: str) -> list[dict]:
+    """Looks up where a specific object was last seen around the user.
+    Args:
+        user_id: The ID of the user.
+        object_name: The name of the object, e.g. "wallet" or "car keys".
+
+    Returns:
+        The best matching objects with their last known location, color, description, the place they were seen in and the relative timestamp of when they were last seen.
+    """
+    terms = registry.object_terms(object_name)
+    if not terms:
+        return []
+
+    entries = await object_collection.find(
+        {"user_id": user_id, "terms": {"$in": terms}},
+        {"name_vector": 0}
+    ).to_list(length=REGISTRY_CANDIDATES)
+
+    return [
+        {
+            "name": entry["name"],
+            "location": entry["location"],
+            "color": entry["color"],
+            "description": entry["description"],
+            "image_location": entry["image_location"],
+            "relative_timestamp": calculate_relative_timestamp(entry["timestamp"])
+        }
+        for entry in registry.rank_entries(entries, object_name)[:3]
+    ]
+
+
+async def touch_visual_context(object_id) -> bool:
+    """Marks a stored visual context as seen again just now.
+
+    Args:
+        object_id: The ObjectId of the visual context.
+
+    Returns:
+        bool: True if the visual context still exists and was updated.
+    """
+    timestamp = datetime.datetime.now().timestamp()
+    result = await visual_collection.update_one(
+        {"_id": ObjectId(object_id)},
+        {"$set": {"timestamp": timestamp, "expires_at": retention.expires_at(timestamp)}}
+    )
+    return result.matched_count > 0
+
+
 async def wipe_conversation_history(user_id: str):
+    await conversation_buffer.discard(user_id)
     await conversation_collection.delete_many({"user_id": user_id})
+    conversation_cache.cache.clear(user_id)
 
 
 async def wipe_visual_history(user_id: str):
+    await visual_buffer.discard(user_id)
+    # a registry write landing after the delete would bring the wiped objects back
+    await _cancel_registry_updates(user_id)
     await visual_collection.delete_many({"user_id": user_id})
+    await object_collection.delete_many({"user_id": user_id})
 
 
-def search_visual_contexts(user_id: str, keywords: list[str], limit: int = 5) -> list[dict]:
-    """
-    Search for visual contexts that contain any of the provided keywords.
-    
+async def search_visual_contexts(user_id: str, keywords: list[str], limit: int = 5) -> list[dict]:
+    """Searches what we saw around the user for specific items, places or colors.
     Args:
         user_id: The ID of the user.
-        keywords: List of keywords to search for in visual contexts.
+        keywords: Words to search for, e.g. the name, color or location of the items the user is asking about.
         limit: Maximum number of results to return.
-        
+
     Returns:
-        A list of matching visual contexts with their relative timestamps.
+        The matching visual contexts along with the relative timestamp of when they occurred, most relevant first.
     """
-    return run_sync(_search_visual_contexts_async(user_id, keywords, limit))
+    return await _search_visual_contexts_async(user_id, keywords, limit)
 
 
-async def _search_visual_contexts_async(user_id: str, keywords: list[str], limit: int = 10) -> list[dict]:
-    # Create a regex pattern for case-insensitive search of any keyword
-    # This will match if any keyword appears in the JSON string representation of visual_context
-    if not keywords or len(keywords) == 0:
-        # If no keywords provided, return most recent contexts
-        return await _fetch_history_async(user_id, limit)
-
-    # Prepare the query - we'll search in the visual_context field
-    # We need to search in the stringified JSON since MongoDB doesn't support
-    # searching within nested JSON structures without text indexes
-    query = {
-        "user_id": user_id,
-        "$or": []
-    }
+async def _recent_visual_contexts(user_id: str, limit: int) -> list[dict]:
+    cursor = visual_collection.find({"user_id": user_id}, {"embeddings": 0}).sort("timestamp", -1).limit(limit)
 
-    # Add a condition for each keyword
-    for keyword in keywords:
-        if keyword and len(keyword.strip()) > 0:
-            # Escape special regex characters
-            escaped_keyword = keyword.replace(".", "\\.").replace("*", "\\*").replace("[", "\\[").replace("]", "\\]")
-            query["$or"].append({
-                "$or": [
-                    # Search in description
-                    {"visual_context.description": {"$regex": escaped_keyword, "$options": "i"}},
-                    # Search in image_location
-                    {"visual_context.image_location": {"$regex": escaped_keyword, "$options": "i"}},
-                    # Search in items names
-                    {"visual_context.items.name": {"$regex": escaped_keyword, "$options": "i"}},
-                    # Search in items descriptions
-                    {"visual_context.items.description": {"$regex": escaped_keyword, "$options": "i"}},
-                    # Search in items locations
-                    {"visual_context.items.location": {"$regex": escaped_keyword, "$options": "i"}},
-                    # Search in items colors
-                    {"visual_context.items.color": {"$regex": escaped_keyword, "$options": "i"}}
-                ]
-            })
+    history = []
+    async for document in cursor:
+        history.append({
+            "visual_context": document["visual_context"],
+            "relative_timestamp": calculate_relative_timestamp(document["timestamp"])
+        })
+
+    return history
 
-    # If no valid keywords were added, return recent contexts
-    if len(query["$or"]) == 0:
-        return await _fetch_history_async(user_id, limit)
 
-    # Execute the query, sort by timestamp (newest first)
-    cursor = visual_collection.find(query).sort("timestamp", -1).limit(limit)
+async def _search_visual_contexts_async(user_id: str, keywords: list[str], limit: int = 10) -> list[dict]:
+    query_terms = sorted({term for keyword in keywords or [] for term in search.tokenize(keyword)})
+    if not query_terms:
+        # If no usable keywords provided, return most recent contexts
+        return await _recent_visual_contexts(user_id, limit)
+
+    # The multikey index on search_terms finds the candidate scenes, ranking happens here
+    cursor = visual_collection.find(
+        {"user_id": user_id, "search_terms": {"$in": query_terms}},
+        {"embeddings": 0}
+    ).sort("timestamp", -1).limit(SEARCH_CANDIDATES)
+    candidates = await cursor.to_list(length=SEARCH_CANDIDATES)
 
-    # Process results
     history = []
-    async for document in cursor:
+    for _, document in search.rank(candidates, query_terms)[:limit]:
         history.append({
             "visual_context": document["visual_context"],
             "relative_timestamp": calculate_relative_timestamp(document["timestamp"])
@@ -174,21 +455,207 @@ async def _search_visual_contexts_async(user_id: str, keywords: list[str], limit
     return history
 
 
-def search_visual_contexts_sync(user_id: str, keywords: list[str], limit: int = 10) -> list[dict]:
+async def backfill_scene_index(batch_size: int = 500) -> int:
+    """Adds search terms, LSH bands and an expiry date to visual contexts saved before they had them,
+    and an expiry date to the registry entries recorded before they had one.
+
+    No index serves this query, it scans the whole collection. It is a one-off migration run by
+    migrate_scene_index.py, not something to run on every startup.
+
+    Returns:
+        The number of visual contexts and registry entries updated.
     """
-    Synchronous wrapper for search_visual_contexts.
-    
-    Args:
-        user_id: The ID of the user.
-        keywords: List of keywords to search for in visual contexts.
-        limit: Maximum number of results to return.
-        
+    cursor = visual_collection.find(
+        {"$or": [
+            {"search_terms": {"$exists": False}},
+            {"lsh_bands": {"$exists": False}},
+            {"expires_at": {"$exists": False}},
+        ]},
+        {"visual_context": 1, "timestamp": 1}
+    )
+    updated = 0
+    operations = []
+    async for document in cursor:
+        operations.append(UpdateOne(
+            {"_id": document["_id"]},
+            {"$set": {
+                "search_terms": search.index_terms(document["visual_context"]),
+                **lsh.index_fields(document["visual_context"]),
+                "expires_at": retention.expires_at(document["timestamp"]),
+            }}
+        ))
+        if len(operations) >= batch_size:
+            await visual_collection.bulk_write(operations, ordered=False)
+            updated += len(operations)
+            operations = []
+
+    if operations:
+        await visual_collection.bulk_write(operations, ordered=False)
+        updated += len(operations)
+
+    # Registry entries recorded before they had an expiry date
+    operations = []
+    async for entry in object_collection.find({"expires_at": {"$exists": False}}, {"timestamp": 1}):
+        operations.append(UpdateOne(
+            {"_id": entry["_id"]}, {"$set": {"expires_at": retention.expires_at(entry["timestamp"])}}))
+        if len(operations) >= batch_size:
+            await object_collection.bulk_write(operations, ordered=False)
+            updated += len(operations)
+            operations = []
+
+    if operations:
+        await object_collection.bulk_write(operations, ordered=False)
+        updated += len(operations)
+    return updated
+
+
+# Compactor passes tell their claims apart with this, every worker process runs its own compactor
+COMPACTOR_ID = f"{socket.gethostname()}:{os.getpid()}"
+# Attempts at writing a summary that other compactors keep updating at the same time
+SUMMARY_WRITE_ATTEMPTS = 5
+
+
+def _compaction_filter(cutoff: float, now: float) -> dict:
+    """Scenes old enough to be compacted that no other compactor is working on."""
+    return {
+        "timestamp": {"$lt": cutoff},
+        "summary_key": {"$exists": False},
+        "$or": [
+            {"compacting_at": {"$exists": False}},
+            {"compacting_at": {"$lt": now - retention.COMPACTION_CLAIM_TIMEOUT}},
+        ],
+    }
+
+
+async def _merge_location(user_id: str, key: str, documents: list[dict]):
+    """Merges scenes into the summary of their location.
+
+    The summary is rewritten only if its version is still the one that was read, so concurrent
+    compactors never overwrite each other's merges. The ids of the merged scenes are recorded on
+    the summary until the scenes are deleted.
+    """
+    for _ in range(SUMMARY_WRITE_ATTEMPTS):
+        summary = await visual_collection.find_one({"user_id": user_id, "summary_key": key})
+        merged = retention.merge_scenes(summary, documents)
+        if merged is None:
+            return
+
+        version = summary.get("version") if summary is not None else None
+        visual_context = merged["visual_context"]
+        try:
+            result = await visual_collection.update_one(
+                {"user_id": user_id, "summary_key": key, "version": version},
+                {
+                    "$set": {
+                        **merged,
+                        "embeddings": await comparisons.embed_items(visual_context["items"]),
+                        "search_terms": search.index_terms(visual_context),
+                        **lsh.index_fields(visual_context),
+                        "expires_at": retention.expires_at(merged["timestamp"]),
+                        "version": (version or 0) + 1,
+                    },
+                    "$addToSet": {"merged_ids": {"$each": [document["_id"] for document in documents]}},
+                },
+                upsert=True
+            )
+        except DuplicateKeyError:
+            continue  # the summary changed version since it was read
+        if result.matched_count or result.upserted_id is not None:
+            return
+
+    raise RuntimeError(f"Could not update the summary of {key} for {user_id}")
+
+
+async def _claim_batch(cutoff: float) -> tuple[str, list[dict]]:
+    """Claims the oldest scenes to compact, so no other compactor merges them too.
+
+    Returns:
+        The claim token, and the claimed scenes.
+    """
+    now = datetime.datetime.now().timestamp()
+    candidates = await visual_collection.find(_compaction_filter(cutoff, now), {"_id": 1}) \
+        .sort("timestamp", 1).limit(retention.COMPACTION_BATCH_SIZE).to_list(length=retention.COMPACTION_BATCH_SIZE)
+    if not candidates:
+        return None, []
+
+    token = f"{COMPACTOR_ID}:{uuid.uuid4().hex}"
+    await visual_collection.update_many(
+        {"_id": {"$in": [candidate["_id"] for candidate in candidates]}, **_compaction_filter(cutoff, now)},
+        {"$set": {"compacting_by": token, "compacting_at": now}}
+    )
+    batch = await visual_collection.find(
+        {"_id": {"$in": [candidate["_id"] for candidate in candidates]}, "compacting_by": token},
+        {"user_id": 1, "visual_context": 1, "timestamp": 1}
+    ).to_list(length=len(candidates))
+    return token, batch
+
+
+async def compact_visual_history(now: float = None) -> int:
+    """Merges the scenes older than the full detail tier into one summary per user and location.
+
+    Scenes are compacted oldest first, COMPACTION_BATCH_SIZE at a time. Each batch is claimed first,
+    so the compactors of several workers never merge the same scenes. A scene is only deleted once
+    its summary is written. If a pass is interrupted in between, the claim expires, and the next
+    pass deletes the scene without counting it in the summary again.
+
     Returns:
-        A list of matching visual contexts with their relative timestamps.
+        The number of scenes merged.
     """
-    return run_sync(search_visual_contexts(user_id, keywords, limit))
+    cutoff = retention.full_detail_cutoff(now or datetime.datetime.now().timestamp())
+    merged = 0
+    while True:
+        token, batch = await _claim_batch(cutoff)
+        if not batch:
+            return merged
+
+        groups = {}
+        for document in batch:
+            key = retention.location_key(document["visual_context"])
+            groups.setdefault((document["user_id"], key), []).append(document)
+        try:
+            for (user_id, key), documents in groups.items():
+                await _merge_location(user_id, key, documents)
+        except Exception:
+            # Hands the scenes that were not merged back to the next pass
+            await visual_collection.update_many(
+                {"_id": {"$in": [document["_id"] for document in batch]}, "compacting_by": token},
+                {"$unset": {"compacting_by": "", "compacting_at": ""}}
+            )
+            raise
+
+        ids = [document["_id"] for document in batch]
+        # Registry entries pointing at the merged scenes now point at their summary
+        for (user_id, key), documents in groups.items():
+            summary = await visual_collection.find_one({"user_id": user_id, "summary_key": key}, {"_id": 1})
+            await object_collection.update_many(
+                {"user_id": user_id, "scene_id": {"$in": [document["_id"] for document in documents]}},
+                {"$set": {"scene_id": summary["_id"]}}
+            )
+        await visual_collection.delete_many({"_id": {"$in": ids}, "compacting_by": token})
+        for user_id, key in groups:
+            await visual_collection.update_one(
+                {"user_id": user_id, "summary_key": key}, {"$pull": {"merged_ids": {"$in": ids}}})
+
+        merged += len(batch)
+        metrics.increment("compaction.scenes_merged", len(batch))
+        if len(batch) < retention.COMPACTION_BATCH_SIZE:
+            return merged
+
+
+async def run_compactor():
+    """Compacts old visual contexts every COMPACTION_INTERVAL seconds, until cancelled."""
+    while True:
+        start = time.perf_counter()
+        try:
+            merged = await compact_visual_history()
+            if merged:
+                print(f"Compacted {merged} old visual contexts into location summaries")
+        except Exception as e:
+            print(f"Error compacting visual history: {str(e)}")
+        metrics.record_latency("compaction.run", time.perf_counter() - start)
+        await asyncio.sleep(retention.COMPACTION_INTERVAL)
+
 
-# TK Maybe we pass doc and have this be in comparisons.py
 # Asynchronously compares two documents from a database based on their 'visual_context' items
 # Returns True if the similarity score exceeds the specified threshold.
 async def compare_visuals(id1: str, id2: str, item_threshold=0.7) -> bool:
@@ -206,41 +673,58 @@ async def compare_visuals(id1: str, id2: str, item_threshold=0.7) -> bool:
         bool: True if the similarity score between the documents exceeds the threshold,
               False otherwise.
     """
-    # print("begin")
     doc1 = await visual_collection.find_one({"_id": ObjectId(id1)})
     doc2 = await visual_collection.find_one({"_id": ObjectId(id2)})
     if not doc1 or not doc2:
         return False
 
+    return bool(await compare_visuals_many(doc1, [doc2], item_threshold))
 
-    similarity_value = await comparisons.compare_docs(doc1, doc2)
-    # print(similarity_value)
-    return similarity_value > item_threshold
+
+async def compare_visuals_many(doc: dict, candidates: list[dict], item_threshold=0.7, reverse=False) -> list[dict]:
+    """
+    Compares one already loaded visual document against many candidates in a single pass
+    and returns the candidates whose similarity exceeds a specified threshold.
+
+    Args:
+        doc (dict): The visual document to compare.
+        candidates (list[dict]): The candidate documents, e.g. loaded with a single $in query.
+        item_threshold (float): The similarity threshold (default is 0.7) to determine
+                                 if two documents are considered a match.
+        reverse (bool): Score each candidate's items against doc instead of doc's items
+                        against each candidate.
+
+    Returns:
+        list[dict]: The matching candidates, in the order they were given.
+    """
+    if not candidates:
+        return []
+
+    scores = await comparisons.compare_doc_to_many(doc, candidates, reverse)
+    return [candidate for candidate, score in zip(candidates, scores) if score > item_threshold]
 
 
 async def _find_similar_entries(doc) -> list[str]:
     """
-    Find documents that are similar to the given document based on basic fields.
-    This is a lightweight comparison using a low threshold for speed.
+    Find documents that are likely near-duplicates of the given document.
+    Candidates come from the per-user LSH index (scenes sharing at least one MinHash band) and are
+    kept if their estimated Jaccard similarity reaches LSH_MIN_SIMILARITY.
     """
-    # Get all documents for the same user
-    user_id = doc["user_id"]
-    similar_docs = await visual_collection.find({"user_id": user_id}).to_list(length=1000)
-
-    # Filter for documents with basic similarity checks on the fields
-    filtered_docs = []
-    for existing_doc in similar_docs:
-        # Check if the name and color are similar enough (you can add other fields here)
-        if existing_doc["_id"] != doc["_id"]:
-            desc_sim = comparisons.fast_similarity(doc["visual_context"]["description"],
-                                               existing_doc["visual_context"]["description"])
-            # color_sim = comparisons.fast_similarity(doc["color"], existing_doc["color"])
-            # If both fields have a nonzero similarity, consider the documents potentially similar enough
-            if desc_sim > 0.1:
-                filtered_docs.append(existing_doc["_id"])
+    if "lsh_bands" not in doc:
+        doc = {**doc, **lsh.index_fields(doc["visual_context"])}
+    minhash = lsh.load_signature(doc)
 
+    cursor = visual_collection.find(
+        {"user_id": doc["user_id"], "lsh_bands": {"$in": doc["lsh_bands"]}, "_id": {"$ne": doc["_id"]},
+         "summary_key": {"$exists": False}},
+        {"minhash": 1}
+    )
+    candidates = await cursor.to_list(length=1000)
 
-    return filtered_docs
+    return [
+        candidate["_id"] for candidate in candidates
+        if lsh.estimate_similarity(minhash, lsh.load_signature(candidate)) >= LSH_MIN_SIMILARITY
+    ]
 
 
 async def purge_duplicates_visuals(object_id: str):
@@ -249,20 +733,56 @@ async def purge_duplicates_visuals(object_id: str):
     if not doc:
         return
     similar_docs_ids = await _find_similar_entries(doc)
-    # print(f"Found {len(similar_docs_ids)} similar documents")
-    for similar_doc_id in similar_docs_ids:
-        if await compare_visuals(object_id, similar_doc_id, 0.7):
-            await visual_collection.delete_one({"_id": ObjectId(similar_doc_id)})
-
-async def _purge_on_insert(doc):
-    user_id = doc["user_id"]
-    recent_docs = await visual_collection.find({"user_id": user_id}).sort("timestamp", -1).limit(5).to_list(length=5)
-    recent_docs = [d for d in recent_docs if str(d["_id"]) != str(doc["_id"])]
-
-    for existing_doc in recent_docs:
-        if await compare_visuals(existing_doc["_id"], doc["_id"], 0.7):
-            # If the similarity is too high, delete the existing document
-            await visual_collection.delete_one({"_id": existing_doc["_id"]})
-            return True
-    return False
+    if not similar_docs_ids:
+        return
+
+    candidates = await visual_collection.find({"_id": {"$in": similar_docs_ids}}).to_list(length=None)
+    duplicates = await compare_visuals_many(doc, candidates, 0.7)
+    if duplicates:
+        await visual_collection.delete_many({"_id": {"$in": [duplicate["_id"] for duplicate in duplicates]}})
 
+async def _purge_recent_duplicates(user_id: str, new_count: int):
+    """
+    Purges duplicates of a user's newest scenes.
+
+    Each of the new_count most recent scenes, oldest first, is compared with the DEDUP_WINDOW
+    scenes saved before it, and the most recent one it duplicates is deleted.
+    """
+    recent_docs = await visual_collection.find({"user_id": user_id, "summary_key": {"$exists": False}}) \
+        .sort("timestamp", -1) \
+        .limit(new_count + DEDUP_WINDOW).to_list(length=new_count + DEDUP_WINDOW)
+    recent_docs.reverse()  # oldest first
+
+    deleted = set()
+    for i in range(max(0, len(recent_docs) - new_count), len(recent_docs)):
+        doc = recent_docs[i]
+        # Newest first, so the most recent duplicate is the one deleted
+        previous_docs = [d for d in reversed(recent_docs[:i]) if d["_id"] not in deleted][:DEDUP_WINDOW]
+
+        # Each previous document's items are scored against the new document
+        duplicates = await compare_visuals_many(doc, previous_docs, 0.7, reverse=True)
+        if duplicates:
+            deleted.add(duplicates[0]["_id"])
+
+    if deleted:
+        await visual_collection.delete_many({"_id": {"$in": list(deleted)}})
+
+
+# Scenes waiting for the registry worker, per user, oldest first
+_registry_pending = {}
+# The registry pass running for a user: {"cancelled", "done"}
+_registry_passes = {}
+
+registry_queue = CoalescingQueue(
+    "registry",
+    _update_registry_for_user,
+    max_keys=int(os.getenv('REGISTRY_MAX_PENDING_USERS', 1000)),
+    max_count=REGISTRY_MAX_PENDING_SCENES,
+)
+
+dedup_queue = CoalescingQueue(
+    "dedup",
+    _purge_recent_duplicates,
+    max_keys=int(os.getenv('DEDUP_MAX_PENDING_USERS', 10000)),
+    max_count=DEDUP_MAX_SCENES_PER_PASS,
+)
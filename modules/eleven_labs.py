@@ -1,3 +1,6 @@
+from contextlib import aclosing
+
+from elevenlabs import VoiceSettings
 from elevenlabs.client import AsyncElevenLabs
 from dotenv import load_dotenv
 import os
@@ -8,5 +11,43 @@ client = AsyncElevenLabs(
     api_key=os.getenv('ELEVEN_LABS_KEY'),
 )
 
+VOICE_ID = os.getenv('ELEVEN_LABS_VOICE_ID')
+MODEL_ID = "eleven_flash_v2_5"
+OUTPUT_FORMAT = "mp3_22050_32"
+
+voice_settings = VoiceSettings(
+    stability=0.0,
+    similarity_boost=1.0,
+    style=0.0,
+    use_speaker_boost=True,
+    speed=1.05,
+)
+
 async def get_eleven_client():
-    return client
\ No newline at end of file
+    return client
+
+async def synthesize(text: str, previous_text: str = None):
+    """Streams the speech audio of a text from ElevenLabs as it is generated.
+
+    Closing this generator early (e.g. when the client disconnects) closes the upstream request.
+
+    Args:
+        text: The text to speak.
+        previous_text: Optional text spoken right before, so a sentence-by-sentence answer keeps its intonation.
+
+    Yields:
+        Chunks of MP3 audio.
+    """
+    response = client.text_to_speech.convert(
+        voice_id=VOICE_ID,
+        output_format=OUTPUT_FORMAT,
+        text=text,
+        model_id=MODEL_ID,
+        voice_settings=voice_settings,
+        **({"previous_text": previous_text} if previous_text else {}),
+    )
+
+    async with aclosing(response) as chunks:
+        async for chunk in chunks:
+            if chunk:
+                yield chunk
@@ -0,0 +1,90 @@
+import io
+import os
+from collections import OrderedDict, deque
+
+from dotenv import load_dotenv
+from PIL import Image
+
+load_dotenv()
+
+# Frames whose hashes differ in fewer bits than this are considered the same scene
+MAX_HASH_DISTANCE = int(os.getenv('FRAME_HASH_MAX_DISTANCE', 6))
+# How many recent frames are remembered per user, and for how many users
+FRAMES_PER_USER = int(os.getenv('FRAME_HASH_FRAMES_PER_USER', 5))
+MAX_USERS = int(os.getenv('FRAME_HASH_MAX_USERS', 1000))
+
+HASH_SIZE = 8
+
+
+def dhash(image_data: bytes) -> int:
+    """
+    Computes the 64-bit difference hash (dHash) of an image.
+
+    The image is shrunk to a 9x8 grayscale thumbnail and every bit records whether a pixel is
+    brighter than its right neighbour, so small changes in exposure, compression or framing
+    only flip a few bits.
+
+    Args:
+        image_data: The raw image bytes.
+
+    Returns:
+        int: The hash.
+    """
+    img = Image.open(io.BytesIO(image_data))
+    # JPEG frames only need to be decoded at 1/8 scale for a 9x8 thumbnail
+    img.draft('L', (HASH_SIZE * 8, HASH_SIZE * 8))
+    pixels = list(img.convert('L').resize((HASH_SIZE + 1, HASH_SIZE), Image.Resampling.BILINEAR).getdata())
+
+    value = 0
+    for row in range(HASH_SIZE):
+        for col in range(HASH_SIZE):
+            left = pixels[row * (HASH_SIZE + 1) + col]
+            right = pixels[row * (HASH_SIZE + 1) + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def hamming_distance(hash1: int, hash2: int) -> int:
+    return (hash1 ^ hash2).bit_count()
+
+
+class RecentFrames:
+    """Remembers the hashes of each user's most recent frames with the scene they were saved as."""
+
+    def __init__(self, frames_per_user: int, max_users: int):
+        self.frames_per_user = frames_per_user
+        self.max_users = max_users
+        self._users = OrderedDict()  # user_id -> deque of frames, least recently active user first
+
+    def find(self, user_id: str, frame_hash: int):
+        """Returns the closest recent frame of the user within MAX_HASH_DISTANCE, or None."""
+        frames = self._users.get(user_id)
+        if not frames:
+            return None
+        self._users.move_to_end(user_id)
+
+        closest = min(frames, key=lambda frame: hamming_distance(frame["hash"], frame_hash))
+        if hamming_distance(closest["hash"], frame_hash) < MAX_HASH_DISTANCE:
+            return closest
+        return None
+
+    def add(self, user_id: str, frame_hash: int, scene_id, visual_context: dict):
+        frames = self._users.get(user_id)
+        if frames is None:
+            frames = self._users[user_id] = deque(maxlen=self.frames_per_user)
+        self._users.move_to_end(user_id)
+        frames.append({"hash": frame_hash, "scene_id": scene_id, "visual_context": visual_context})
+
+        while len(self._users) > self.max_users:
+            self._users.popitem(last=False)
+
+    def forget(self, user_id: str, frame: dict):
+        frames = self._users.get(user_id)
+        if frames and frame in frames:
+            frames.remove(frame)
+
+    def clear(self, user_id: str):
+        self._users.pop(user_id, None)
+
+
+recent_frames = RecentFrames(FRAMES_PER_USER, MAX_USERS)
@@ -2,14 +2,14 @@ from google import genai
 from pydantic import BaseModel
 from dotenv import load_dotenv
 from google.genai import types
-from modules import database
+from modules import database, scheduler
+from utils import metrics
 from utils.common import remove_formatting
 
+import asyncio
 import json
 import os
 import time
-import random
-from google.genai import errors
 
 load_dotenv()
 
@@ -31,18 +31,197 @@ visual_context_config = types.GenerateContentConfig(
     response_mime_type='application/json'
 )
 
+# Tools the model can call while answering a question. They are coroutines and are executed by
+# generate_with_tools on the server's event loop, so automatic (sync) function calling is disabled.
+query_tools = {tool.__name__: tool for tool in [
+    database.fetch_history,
+    database.get_conversation_history,
+    database.search_visual_contexts,
+    database.find_object,
+]}
+
 query_config = types.GenerateContentConfig(
-    tools=[database.fetch_history, database.get_conversation_history],
+    tools=[types.Tool(function_declarations=[
+        types.FunctionDeclaration.from_callable(client=client, callable=tool) for tool in query_tools.values()
+    ])],
+    automatic_function_calling=types.AutomaticFunctionCallingConfig(disable=True),
+    response_mime_type='text/plain',
+    temperature=1.0
+)
+
+# Same as query_config for the "prefetch" context mode, where the history is inlined in the prompt
+prefetch_query_config = types.GenerateContentConfig(
+    automatic_function_calling=types.AutomaticFunctionCallingConfig(disable=True),
     response_mime_type='text/plain',
     temperature=1.0
 )
 
-async def get_visual_context(picture_file):
+class StreamInterrupted(Exception):
+    """Raised by generate_response_stream when the answer fails after part of it was yielded."""
+
+# "tools" lets the model fetch the history with function calls, "prefetch" inlines it in a single call
+CONTEXT_MODE = os.getenv('GEMINI_CONTEXT_MODE', 'tools')
+
+MAX_TOOL_ROUNDS = 5
+
+# Media up to this size is sent inline with the generate_content request instead of through the Files API
+INLINE_MAX_BYTES = int(os.getenv('GEMINI_INLINE_MAX_BYTES', 8 * 1024 * 1024))
+
+# Keeps references to fire-and-forget cleanup tasks so they aren't garbage collected mid-flight
+_background_tasks = set()
+
+async def _generate_content(priority, max_retries=3, **kwargs):
+    """Calls generate_content through the Gemini request scheduler."""
+    return await scheduler.gemini_scheduler.run(
+        lambda: client.aio.models.generate_content(**kwargs), priority, max_retries)
+
+def _open_stream(priority, max_retries=3, **kwargs):
+    """Opens a generate_content_stream through the Gemini request scheduler.
+
+    Use as `async with _open_stream(...) as stream`. The stream holds its scheduler slot until it
+    is closed, and a 429 before its first chunk is retried.
+    """
+    return scheduler.gemini_scheduler.stream(
+        lambda: client.aio.models.generate_content_stream(**kwargs), priority, max_retries)
+
+async def _upload_file(priority, file, config):
+    """Uploads a file to the Files API through the Gemini request scheduler."""
+    def upload():
+        file.seek(0)  # a retried upload has to start from the beginning again
+        return client.aio.files.upload(file=file, config=config)
+
+    return await scheduler.gemini_scheduler.run(upload, priority)
+
+async def _media_part(priority, file, mime_type, inline=True):
+    """Prepares media for a generate_content request.
+
+    Media up to INLINE_MAX_BYTES is sent inline, saving the upload round trip. Larger media is
+    uploaded to the Files API, and so is all media when inline is False. Requests that resend their
+    contents, like the rounds of a tool-calling loop, should not inline it.
+
+    Returns:
+        The part to put in the contents, and the uploaded file to delete afterwards (or None).
+    """
+    file.seek(0)
+    data = file.read()
+    file.seek(0)
+    if inline and len(data) <= INLINE_MAX_BYTES:
+        return types.Part.from_bytes(data=data, mime_type=mime_type), None
+
+    uploaded = await _upload_file(priority, file=file, config=types.UploadFileConfig(mime_type=mime_type))
+    return uploaded, uploaded
+
+async def _delete_upload(upload):
+    try:
+        await scheduler.gemini_scheduler.run(lambda: client.aio.files.delete(name=upload.name), scheduler.BACKGROUND)
+    except Exception as e:
+        print(f"Error deleting uploaded file {upload.name}: {str(e)}")
+
+def _delete_uploads(uploads):
+    """Deletes uploaded files in the background once the request that used them is done."""
+    for upload in uploads:
+        if upload is None:
+            continue
+        task = asyncio.create_task(_delete_upload(upload))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+
+def _to_part(content):
+    """Converts a prompt string or an uploaded file into a Part."""
+    if isinstance(content, str):
+        return types.Part.from_text(text=content)
+    if isinstance(content, types.File):
+        return types.Part.from_uri(file_uri=content.uri, mime_type=content.mime_type)
+    return content
+
+async def _call_tool(function_call, tools):
+    """Runs a single tool call requested by the model and wraps its result as a function response."""
+    tool = tools.get(function_call.name)
+    if tool is None:
+        response = {"error": f"Unknown function {function_call.name}"}
+    else:
+        try:
+            response = {"result": await tool(**(function_call.args or {}))}
+        except Exception as e:
+            print(f"Error running tool {function_call.name}: {str(e)}")
+            response = {"error": str(e)}
+    return types.Part.from_function_response(name=function_call.name, response=response)
+
+async def generate_with_tools(contents, config, tools, model='gemini-2.0-flash', priority=scheduler.INTERACTIVE,
+                              max_retries=3):
+    """Generates content, executing any function calls the model makes as coroutines.
+
+    All function calls requested in one turn run concurrently, and their results are sent back
+    to the model until it answers without calling a tool (or MAX_TOOL_ROUNDS is reached).
+
+    Args:
+        contents: The prompt strings and uploaded files of the user turn.
+        config: The GenerateContentConfig declaring the tools.
+        tools: A mapping of function name to the coroutine function implementing it.
+        model: The model to use.
+        priority: The scheduler lane of the model calls.
+        max_retries: Maximum number of retries of each model call when rate limited.
+
+    Returns:
+        The final GenerateContentResponse.
+    """
+    history = [types.Content(role='user', parts=[_to_part(content) for content in contents])]
+
+    for _ in range(MAX_TOOL_ROUNDS):
+        response = await _generate_content(priority, max_retries, model=model, contents=history, config=config)
+        function_calls = response.function_calls
+        if not function_calls:
+            return response
+
+        history.append(response.candidates[0].content)
+        parts = await asyncio.gather(*(_call_tool(function_call, tools) for function_call in function_calls))
+        history.append(types.Content(role='user', parts=list(parts)))
+
+    return response
+
+async def stream_with_tools(contents, config, tools, model='gemini-2.0-flash', priority=scheduler.INTERACTIVE,
+                            max_retries=3):
+    """Streaming version of generate_with_tools that yields the answer text as it is generated.
+
+    Text is yielded as soon as each chunk arrives. If the model calls tools, they are executed
+    concurrently once its turn has finished streaming and the next turn is streamed the same way.
+    """
+    history = [types.Content(role='user', parts=[_to_part(content) for content in contents])]
+
+    for _ in range(MAX_TOOL_ROUNDS):
+        function_calls = []
+        model_parts = []
+        async with _open_stream(priority, max_retries, model=model, contents=history, config=config) as stream:
+            async for chunk in stream:
+                if not chunk.candidates or not chunk.candidates[0].content or not chunk.candidates[0].content.parts:
+                    continue
+                for part in chunk.candidates[0].content.parts:
+                    model_parts.append(part)
+                    if part.function_call:
+                        function_calls.append(part.function_call)
+                    elif part.text:
+                        yield part.text
+
+        if not function_calls:
+            return
+
+        history.append(types.Content(role='model', parts=model_parts))
+        parts = await asyncio.gather(*(_call_tool(function_call, tools) for function_call in function_calls))
+        history.append(types.Content(role='user', parts=list(parts)))
+
+async def _stream_content(priority, max_retries=3, **kwargs):
+    """Streams the text of a generate_content call without tools."""
+    async with _open_stream(priority, max_retries, **kwargs) as stream:
+        async for chunk in stream:
+            if chunk.text:
+                yield chunk.text
+
+async def get_visual_context(picture_file, mime_type='image/png'):
     """Takes a photo and saves its visual context to the database."""
     if not picture_file:
         raise ValueError("Picture file is required")
     
-    picture = await client.aio.files.upload(file=picture_file, config=types.UploadFileConfig(mime_type='image/png'))
+    picture, upload = await _media_part(scheduler.BACKGROUND, picture_file, mime_type)
     
     base_prompt = f"""
     You are Foresight, an assistant for visually impaired users. You have been given an image of their point of view, create a detailed visual context that includes:
@@ -61,11 +240,15 @@ async def get_visual_context(picture_file):
     Be thorough and precise, as this context will be used to answer future questions about objects seen.
     """
 
-    response = await client.aio.models.generate_content(
-        model='gemini-2.0-flash',
-        contents=[base_prompt, picture],
-        config=visual_context_config
-    )
+    try:
+        response = await _generate_content(
+            scheduler.BACKGROUND,
+            model='gemini-2.0-flash',
+            contents=[base_prompt, picture],
+            config=visual_context_config
+        )
+    finally:
+        _delete_uploads([upload])
 
     visual_context = json.loads(response.text)
     return visual_context
@@ -117,14 +300,8 @@ async def generate_audio_transcription(audio_file=None):
         return "No audio file provided for transcription."
     
     try:
-        # Upload the audio file to Gemini
-        audio_upload = await client.aio.files.upload(
-            file=audio_file, 
-            config=types.UploadFileConfig(mime_type='audio/mpeg')
-        )
-        
-        # Reset the file pointer for potential future use
-        audio_file.seek(0)
+        # Inline the audio, or upload it to Gemini if it is too large
+        audio_part, upload = await _media_part(scheduler.BACKGROUND, audio_file, 'audio/mpeg')
         
         # Create a simple prompt for transcription
         prompt = """
@@ -139,11 +316,15 @@ async def generate_audio_transcription(audio_file=None):
         )
         
         # Generate the transcription using Gemini
-        response = await client.aio.models.generate_content(
-            model='gemini-2.0-flash',
-            contents=[prompt, audio_upload],
-            config=generation_config
-        )
+        try:
+            response = await _generate_content(
+                scheduler.BACKGROUND,
+                model='gemini-2.0-flash',
+                contents=[prompt, audio_part],
+                config=generation_config
+            )
+        finally:
+            _delete_uploads([upload])
         
         # Extract and return the transcribed text
         transcription = response.text.strip()
@@ -153,33 +334,30 @@ async def generate_audio_transcription(audio_file=None):
         return f"Error transcribing audio: {str(e)}"
 
 
-async def generate_response(user_id, audio_file=None, text_query=None, max_retries=3):
-    """Handles user questions about previously saved visual contexts.
-    
+def _query_prompt(user_id, is_audio, context=None):
+    """Builds the question-answering prompt.
+
     Args:
         user_id: The ID of the user.
-        audio_file: Optional audio file containing the user's question.
-        text_query: Optional text query from the user.
-        max_retries: Maximum number of retries for API calls.
-        
-    Returns:
-        The assistant's response as text.
+        is_audio: Whether the question is asked through audio.
+        context: Optional prefetched (conversation history, visual history). When given, both are
+            inlined into the prompt instead of asking the model to call the tools.
     """
-    if not audio_file and not text_query:
-        raise ValueError("Either audio_file or text_query must be provided")
-    
-    files = []
-    if audio_file:
-        audio_upload = await client.aio.files.upload(file=audio_file, config=types.UploadFileConfig(mime_type='audio/mpeg'))
-        files.append(audio_upload)
-    
+    if context is None:
+        context_steps = """2. Use the get_conversation_history function to retrieve previous messages in this conversation
+    3. When asked where a specific object is, use the find_object function with its name to get where it was last seen
+    4. When asked about specific items, places or colors, use the search_visual_contexts function with those words to find the scenes they were seen in
+    5. Otherwise, use the fetch_history function to get your visual context history of what you have seen for this user"""
+    else:
+        context_steps = """2. Use the CONVERSATION HISTORY below for the previous messages in this conversation
+    3. Use the VISUAL CONTEXT HISTORY below for what you have seen for this user"""
+
     base_prompt = f"""
     You are Foresight, an intelligent personal assistant that helps users remember and interact with their surroundings. You are responsible for answering their questions about their visual context by leveraging your memory of what you've seen.
-    A user with the user ID {user_id} has asked a question through {'audio' if audio_file else 'text'}. Your task is to:
+    A user with the user ID {user_id} has asked a question through {'audio' if is_audio else 'text'}. Your task is to:
 
-    1. {'Listen to the audio question and provide a clear answer.' if audio_file else 'Read the text question and provide a clear answer.'}
-    2. Use the get_conversation_history function to retrieve previous messages in this conversation
-    3. Use the fetch_history function to get your visual context history of what you have seen for this user
+    1. {'Listen to the audio question and provide a clear answer.' if is_audio else 'Read the text question and provide a clear answer.'}
+    {context_steps}
 
     HANDLING CONTEXT AND FOLLOW-UP QUESTIONS:
     - When a user asks "What items have you seen?" - list all items from your visual contexts with their locations
@@ -208,51 +386,173 @@ async def generate_response(user_id, audio_file=None, text_query=None, max_retri
     MOST IMPORTANT: When responding to a follow-up question, ALWAYS check what specific items you mentioned in your previous response and address THOSE items specifically.
     """
 
-    contents = [base_prompt, *files]
+    if context is not None:
+        conversation_history, visual_history = context
+        base_prompt += f"""
+    CONVERSATION HISTORY:
+    {json.dumps(conversation_history)}
+
+    VISUAL CONTEXT HISTORY:
+    {visual_history}
+    """
+
+    return base_prompt
+
+async def _prefetch_context(user_id, text_query=None):
+    """Fetches the conversation and visual history of a user concurrently.
+
+    The visual history puts the scenes relevant to a text question first.
+    """
+    return await asyncio.gather(
+        database.get_conversation_history(user_id),
+        database.render_visual_history(user_id, text_query)
+    )
+
+async def _prepare_query(user_id, audio_file, text_query, context_mode):
+    """Builds the contents of a question, prefetching the user's history while the audio uploads.
+
+    Returns:
+        The contents, and the uploaded files to delete once the answer has been generated.
+    """
+    prefetch = asyncio.create_task(_prefetch_context(user_id, text_query)) if context_mode == "prefetch" else None
+    uploads = []
+    try:
+        files = []
+        if audio_file:
+            # Every tool round resends the whole history, which would carry inline audio each time
+            audio_part, upload = await _media_part(
+                scheduler.INTERACTIVE, audio_file, 'audio/mpeg', inline=context_mode != "tools")
+            files.append(audio_part)
+            uploads.append(upload)
+
+        context = await prefetch if prefetch else None
+    except BaseException:
+        if prefetch:
+            prefetch.cancel()
+        _delete_uploads(uploads)
+        raise
+
+    contents = [_query_prompt(user_id, bool(audio_file), context), *files]
     if text_query:
         contents.append(text_query)
+    return contents, uploads
+
 
-    # Implement retry with exponential backoff
-    retry_count = 0
-    base_wait_time = 2  # Start with 2 seconds
+async def generate_response(user_id, audio_file=None, text_query=None, max_retries=3, context_mode=None):
+    """Handles user questions about previously saved visual contexts.
     
-    while retry_count <= max_retries: 
-        try:
-            response = await client.aio.models.generate_content(
+    Args:
+        user_id: The ID of the user.
+        audio_file: Optional audio file containing the user's question.
+        text_query: Optional text query from the user.
+        max_retries: Maximum number of retries for API calls.
+        context_mode: "tools" lets the model call the history tools, "prefetch" fetches both histories
+            up front and answers in a single model call. Defaults to GEMINI_CONTEXT_MODE.
+        
+    Returns:
+        The assistant's response as text.
+    """
+    if not audio_file and not text_query:
+        raise ValueError("Either audio_file or text_query must be provided")
+
+    context_mode = "prefetch" if (context_mode or CONTEXT_MODE) == "prefetch" else "tools"
+    start = time.perf_counter()
+    contents, uploads = await _prepare_query(user_id, audio_file, text_query, context_mode)
+
+    # Rate limiting, 429 backoff and retries are handled by the scheduler
+    try:
+        if context_mode == "prefetch":
+            response = await _generate_content(
+                scheduler.INTERACTIVE,
+                max_retries,
                 model='gemini-2.0-flash',
                 contents=contents,
-                config=query_config
+                config=prefetch_query_config
             )
-            
-            response_text = response.text.strip()
-            response_text = remove_formatting(response_text)
-
-            # Save the user's message to conversation history
-            if text_query:
-                await database.save_message(user_id, "user", text_query)
-            
-            return response_text
-
-        except errors.ClientError as e:
-            # Check if it's a rate limit error (429)
-            if hasattr(e, 'status_code') and e.status_code == 429:
-                retry_count += 1
-                
-                if retry_count > max_retries:
-                    # If we've exceeded max retries, use a fallback response
-                    fallback_response = generate_fallback_response(text_query)
-                    return fallback_response
-                
-                # Calculate wait time with exponential backoff and jitter
-                wait_time = base_wait_time * (2 ** (retry_count - 1)) + random.uniform(0, 1)
-                print(f"Rate limit exceeded. Retrying in {wait_time:.2f} seconds...")
-                time.sleep(wait_time)
-            else:
-                # For other errors, use fallback and don't retry
-                fallback_response = generate_fallback_response(text_query)
-                return fallback_response
-        except Exception as e:
-            # For any other exception, use fallback
-            print(f"Error generating response: {str(e)}")
-            fallback_response = generate_fallback_response(text_query)
-            return fallback_response
\ No newline at end of file
+        else:
+            response = await generate_with_tools(contents, query_config, query_tools, max_retries=max_retries)
+
+        response_text = response.text.strip()
+        response_text = remove_formatting(response_text)
+        metrics.record_latency(f"generate_response.{context_mode}", time.perf_counter() - start)
+
+        # Save the user's message to conversation history
+        if text_query:
+            await database.save_message(user_id, "user", text_query)
+
+        return response_text
+
+    except Exception as e:
+        # Still rate limited after max_retries, or any other error: use a fallback
+        print(f"Error generating response: {str(e)}")
+        fallback_response = generate_fallback_response(text_query)
+        return fallback_response
+    finally:
+        _delete_uploads(uploads)
+
+async def generate_response_stream(user_id, audio_file=None, text_query=None, max_retries=3, context_mode=None):
+    """Streams the answer to a user question about previously saved visual contexts.
+
+    Same as generate_response, except the answer is yielded chunk by chunk as the model generates it,
+    with formatting removed from every chunk.
+
+    Args:
+        user_id: The ID of the user.
+        audio_file: Optional audio file containing the user's question.
+        text_query: Optional text query from the user.
+        max_retries: Maximum number of retries for API calls.
+        context_mode: "tools" or "prefetch", see generate_response.
+
+    Yields:
+        Chunks of the assistant's response text. If the model fails before the first chunk, the
+        fallback response is yielded instead.
+
+    Raises:
+        StreamInterrupted: The model failed after part of the answer was yielded, which is then
+            incomplete.
+    """
+    if not audio_file and not text_query:
+        raise ValueError("Either audio_file or text_query must be provided")
+
+    context_mode = "prefetch" if (context_mode or CONTEXT_MODE) == "prefetch" else "tools"
+    start = time.perf_counter()
+    contents, uploads = await _prepare_query(user_id, audio_file, text_query, context_mode)
+
+    if context_mode == "prefetch":
+        chunks = _stream_content(
+            scheduler.INTERACTIVE,
+            max_retries,
+            model='gemini-2.0-flash',
+            contents=contents,
+            config=prefetch_query_config
+        )
+    else:
+        chunks = stream_with_tools(contents, query_config, query_tools, max_retries=max_retries)
+
+    streamed = False
+    try:
+        async for text in chunks:
+            # remove_formatting works character by character, so applying it per chunk is exact
+            text = remove_formatting(text)
+            if not streamed:
+                text = text.lstrip()
+                if not text:
+                    continue
+                streamed = True
+                metrics.record_latency(f"generate_response_stream.{context_mode}.first_token", time.perf_counter() - start)
+            yield text
+    except Exception as e:
+        print(f"Error streaming response: {str(e)}")
+        if streamed:
+            metrics.increment(f"generate_response_stream.{context_mode}.interrupted")
+            raise StreamInterrupted(str(e)) from e
+        yield generate_fallback_response(text_query)
+        return
+    finally:
+        _delete_uploads(uploads)
+
+    metrics.record_latency(f"generate_response_stream.{context_mode}", time.perf_counter() - start)
+
+    # Save the user's message to conversation history
+    if text_query:
+        await database.save_message(user_id, "user", text_query)
@@ -0,0 +1,125 @@
+import json
+import os
+import time
+
+from dotenv import load_dotenv
+
+from modules import registry, search
+from utils.common import calculate_relative_timestamp
+
+load_dotenv()
+
+# Rough prompt size of the rendered visual history, in tokens
+TOKEN_BUDGET = int(os.getenv('HISTORY_TOKEN_BUDGET', 2000))
+# Scene descriptions longer than this are cut, the items carry the details
+DESCRIPTION_MAX_CHARS = 160
+# Gemini averages about four characters of English per token
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text: str) -> int:
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def item_key(item: dict) -> tuple[str, str]:
+    # Different colored mugs are different mugs
+    return registry.object_key(item.get("name", "")), " ".join(search.tokenize(item.get("color", "")))
+
+
+def _item_line(item: dict) -> str:
+    name = item.get("name", "").strip()
+    color = item.get("color", "").strip()
+    location = item.get("location", "").strip()
+    line = f"- {name} ({color})" if color else f"- {name}"
+    return f"{line}: {location}" if location else line
+
+
+def _scene_lines(document: dict, items: list[dict]) -> list[str]:
+    visual_context = document["visual_context"]
+    description = " ".join(visual_context.get("description", "").split())
+    if len(description) > DESCRIPTION_MAX_CHARS:
+        description = description[:DESCRIPTION_MAX_CHARS - 3].rstrip() + "..."
+
+    seen = calculate_relative_timestamp(document["timestamp"])
+    if document.get("scene_count", 1) > 1:
+        # a summary of older scenes at this location, see modules/retention.py
+        seen = f"{seen}, {document['scene_count']} visits since {calculate_relative_timestamp(document['first_seen'])}"
+    header = f"[{seen}] {visual_context.get('image_location', '').strip()}"
+    lines = [f"{header}: {description}" if description else header]
+    lines.extend(_item_line(item) for item in items)
+    return lines
+
+
+def _latest_sightings(documents: list[dict]) -> list[tuple[dict, list[dict]]]:
+    """Pairs every scene with the items last seen in it, dropping scenes with nothing left to say."""
+    seen = set()
+    scenes = []
+    for document in sorted(documents, key=lambda document: document["timestamp"], reverse=True):
+        items = []
+        for item in document["visual_context"].get("items", []):
+            key = item_key(item)
+            if key not in seen:
+                seen.add(key)
+                items.append(item)
+        if items or not document["visual_context"].get("items"):
+            scenes.append((document, items))
+    return scenes
+
+
+def render(documents: list[dict], query_terms: list[str] = None, budget: int = TOKEN_BUDGET,
+           now: float = None) -> tuple[str, dict]:
+    """Renders scenes as a compact, token-budgeted visual history for a prompt.
+
+    Items seen in several scenes are only listed under the most recent one. Scenes relevant to
+    the query terms come first, best first, then the rest from newest to oldest. Scenes are added
+    until the budget is spent and the number left out is noted at the end.
+
+    Args:
+        documents: The scene documents, with visual_context and timestamp.
+        query_terms: Optional normalized search terms of the question.
+        budget: The token budget of the rendered history.
+        now: The current unix timestamp.
+
+    Returns:
+        The rendered history, and stats with the estimated tokens used and saved compared to the
+        full visual contexts as JSON.
+    """
+    now = now or time.time()
+    scenes = _latest_sightings(documents)
+
+    relevance = {}
+    if query_terms:
+        for score, document in search.rank([document for document, _ in scenes], query_terms, now):
+            relevance[id(document)] = score
+    scenes.sort(key=lambda scene: relevance.get(id(scene[0]), 0.0), reverse=True)  # stable: newest first otherwise
+
+    lines = []
+    used = 0
+    rendered = 0
+    for document, items in scenes:
+        block = "\n".join(_scene_lines(document, items))
+        cost = estimate_tokens(block) + 1
+        if used + cost > budget:
+            continue  # a smaller older scene may still fit
+        lines.append(block)
+        used += cost
+        rendered += 1
+
+    omitted = len(documents) - rendered
+    if omitted:
+        lines.append(f"({omitted} older or repeated scenes omitted)")
+    text = "\n".join(lines)
+
+    full = json.dumps([
+        {"visual_context": document["visual_context"], "relative_timestamp": calculate_relative_timestamp(document["timestamp"])}
+        for document in documents
+    ])
+    tokens = estimate_tokens(text)
+    full_tokens = estimate_tokens(full)
+    return text, {
+        "scenes": len(documents),
+        "rendered": rendered,
+        "tokens": tokens,
+        "full_tokens": full_tokens,
+        "tokens_saved": max(0, full_tokens - tokens),
+    }
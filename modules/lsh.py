@@ -0,0 +1,68 @@
+import hashlib
+import re
+
+import numpy as np
+
+# 64 MinHash permutations split into 16 bands of 4 rows. Two scenes share at least one band with
+# probability 1 - (1 - J^4)^16 for Jaccard similarity J, which crosses 50% around J = 0.5.
+NUM_PERMUTATIONS = 64
+NUM_BANDS = 16
+ROWS_PER_BAND = NUM_PERMUTATIONS // NUM_BANDS
+
+# Words per description shingle
+SHINGLE_SIZE = 3
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+
+# Fixed seed: every worker and every deploy must produce the same signatures for the same scene
+_random = np.random.RandomState(1)
+_A = _random.randint(1, 1 << 32, size=NUM_PERMUTATIONS, dtype=np.uint64)
+_B = _random.randint(0, 1 << 32, size=NUM_PERMUTATIONS, dtype=np.uint64)
+
+_WORD = re.compile(r"[a-z0-9]+")
+
+
+def features(visual_context: dict) -> set[str]:
+    """Returns the word shingles of the scene description plus the names of its items."""
+    words = _WORD.findall(visual_context.get("description", "").lower())
+    shingles = {" ".join(words[i:i + SHINGLE_SIZE]) for i in range(max(1, len(words) - SHINGLE_SIZE + 1))}
+    names = {f"item:{item.get('name', '').lower().strip()}" for item in visual_context.get("items", [])}
+    return (shingles | names) - {""}
+
+
+def signature(feature_set: set[str]) -> np.ndarray:
+    """Computes the MinHash signature of a set of features as NUM_PERMUTATIONS uint32 values."""
+    if not feature_set:
+        return np.full(NUM_PERMUTATIONS, _MAX_HASH, dtype=np.uint32)
+
+    hashes = np.array(
+        [int.from_bytes(hashlib.blake2b(feature.encode(), digest_size=4).digest(), "little") for feature in feature_set],
+        dtype=np.uint64
+    )
+    permuted = ((_A[:, None] * hashes[None, :] + _B[:, None]) % _MERSENNE_PRIME) & _MAX_HASH
+    return permuted.min(axis=1).astype(np.uint32)
+
+
+def band_keys(minhash: np.ndarray) -> list[str]:
+    """Hashes every band of a signature into a key. Scenes sharing a key are duplicate candidates."""
+    keys = []
+    for band in range(NUM_BANDS):
+        rows = minhash[band * ROWS_PER_BAND:(band + 1) * ROWS_PER_BAND]
+        keys.append(f"{band}:{hashlib.blake2b(rows.tobytes(), digest_size=8).hexdigest()}")
+    return keys
+
+
+def estimate_similarity(minhash1: np.ndarray, minhash2: np.ndarray) -> float:
+    """Estimates the Jaccard similarity of two scenes from their signatures."""
+    return float(np.mean(minhash1 == minhash2))
+
+
+def index_fields(visual_context: dict) -> dict:
+    """Returns the fields stored on a scene document for the LSH index."""
+    minhash = signature(features(visual_context))
+    return {"minhash": minhash.tobytes(), "lsh_bands": band_keys(minhash)}
+
+
+def load_signature(document: dict) -> np.ndarray:
+    return np.frombuffer(document["minhash"], dtype=np.uint32)
@@ -0,0 +1,96 @@
+import os
+
+import numpy as np
+from dotenv import load_dotenv
+
+from modules import search
+
+load_dotenv()
+
+# Name vectors at least this similar (cosine) count as the same object, e.g. "mug" and "coffee mug"
+MATCH_THRESHOLD = float(os.getenv('REGISTRY_MATCH_THRESHOLD', 0.85))
+
+
+def object_key(name: str) -> str:
+    """Normalizes an object name, so "Keys" and "the key" are the same object."""
+    return " ".join(search.tokenize(name))
+
+
+def object_terms(name: str) -> list[str]:
+    return sorted(set(search.tokenize(name)))
+
+
+def _entry_vector(entry: dict):
+    if not entry.get("name_vector"):
+        return None
+    return np.frombuffer(entry["name_vector"], dtype=np.float16).astype(np.float32)
+
+
+def match_items(items: list[dict], name_vectors: np.ndarray, entries: list[dict]) -> list:
+    """Matches the items of a new scene to the user's registry entries.
+
+    An item matches an entry with the same object key, or else the entry whose name vector is the
+    most similar above MATCH_THRESHOLD. Each entry is matched at most once per scene, so two chairs
+    in one scene stay two objects.
+
+    Args:
+        items: The items of the new scene.
+        name_vectors: The normalized name vectors of the items, one row per item.
+        entries: The candidate registry entries.
+
+    Returns:
+        For every item, the entry it is a new sighting of, or None if it is a new object.
+    """
+    entry_vectors = [_entry_vector(entry) for entry in entries]
+    claimed = set()
+    matches = []
+
+    for item, vector in zip(items, name_vectors):
+        key = object_key(item["name"])
+        best, best_score = None, MATCH_THRESHOLD
+        for j, entry in enumerate(entries):
+            if j in claimed:
+                continue
+            if entry["key"] == key:
+                score = 1.0
+            elif entry_vectors[j] is not None and entry_vectors[j].shape == vector.shape:
+                score = float(entry_vectors[j] @ vector)
+            else:
+                continue
+            if score >= best_score:
+                best, best_score = j, score
+
+        if best is None:
+            matches.append(None)
+        else:
+            claimed.add(best)
+            matches.append(entries[best])
+
+    return matches
+
+
+def entry_fields(item: dict, visual_context: dict, scene_id, timestamp: float, name_vector: np.ndarray) -> dict:
+    """Returns the fields of a registry entry for the latest sighting of an object."""
+    return {
+        "key": object_key(item["name"]),
+        "name": item["name"],
+        "location": item["location"],
+        "color": item["color"],
+        "description": item["description"],
+        "image_location": visual_context.get("image_location", ""),
+        "scene_id": scene_id,
+        "timestamp": timestamp,
+        "name_vector": name_vector.astype(np.float16).tobytes(),
+    }
+
+
+def rank_entries(entries: list[dict], object_name: str) -> list[dict]:
+    """Orders registry entries by how well they match a looked up name: same object key first,
+    then the most name words in common, then the most recently seen."""
+    key = object_key(object_name)
+    terms = set(object_terms(object_name))
+    return sorted(
+        entries,
+        key=lambda entry: (entry["key"] == key, len(terms & set(entry["terms"])), entry["timestamp"]),
+        reverse=True
+    )
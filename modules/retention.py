@@ -0,0 +1,82 @@
+import datetime
+import os
+
+from dotenv import load_dotenv
+
+from modules import history, search
+
+load_dotenv()
+
+# Scenes newer than this stay in full detail
+FULL_DETAIL_DAYS = float(os.getenv('RETENTION_FULL_DETAIL_DAYS', 7))
+# Scenes and summaries not seen for this long are removed by the TTL index on expires_at. The
+# expiry is stored on every document, so changing it only affects scenes saved or merged afterwards.
+HORIZON_DAYS = float(os.getenv('RETENTION_HORIZON_DAYS', 90))
+# Scenes merged into summaries per compaction batch
+COMPACTION_BATCH_SIZE = int(os.getenv('RETENTION_BATCH_SIZE', 200))
+# Seconds between compaction passes
+COMPACTION_INTERVAL = float(os.getenv('RETENTION_INTERVAL', 3600))
+# Most items kept per location summary, the most recently seen ones
+SUMMARY_MAX_ITEMS = 50
+# Seconds after which scenes claimed by a compactor that never finished can be claimed again
+COMPACTION_CLAIM_TIMEOUT = float(os.getenv('RETENTION_CLAIM_TIMEOUT', 600))
+
+
+def full_detail_cutoff(now: float) -> float:
+    """Returns the timestamp before which scenes are merged into summaries."""
+    return now - FULL_DETAIL_DAYS * 86400
+
+
+def expires_at(timestamp: float) -> datetime.datetime:
+    """Returns when a scene last seen at timestamp is removed. TTL indexes need a date, not a unix timestamp."""
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc) + datetime.timedelta(days=HORIZON_DAYS)
+
+
+def location_key(visual_context: dict) -> str:
+    """Normalizes a scene location, so "the kitchen" and "Kitchen" share a summary."""
+    return " ".join(search.tokenize(visual_context.get("image_location", ""))) or "unknown"
+
+
+def merge_scenes(summary: dict, documents: list[dict]) -> dict:
+    """Merges scenes seen at one location into its summary.
+
+    Every item is kept as it was last seen there, and the location and description come from the
+    most recent scene. Scenes listed in the summary's merged_ids were already merged by a pass that
+    was interrupted before deleting them, and are skipped.
+
+    Args:
+        summary: The existing summary document of the location, or None.
+        documents: The scene documents to merge, all of the same user and location.
+
+    Returns:
+        The visual_context, timestamp, first_seen and scene_count fields of the merged summary, or
+        None if every scene was already merged.
+    """
+    already_merged = set(summary.get("merged_ids", [])) if summary is not None else set()
+    scenes = [document for document in documents if document["_id"] not in already_merged]
+    if not scenes:
+        return None
+    if summary is not None:
+        scenes.append(summary)
+    scenes.sort(key=lambda document: document["timestamp"], reverse=True)
+
+    seen = set()
+    items = []
+    for document in scenes:
+        for item in document["visual_context"].get("items", []):
+            key = history.item_key(item)
+            if key not in seen and len(items) < SUMMARY_MAX_ITEMS:
+                seen.add(key)
+                items.append(item)
+
+    latest = scenes[0]
+    return {
+        "visual_context": {
+            "image_location": latest["visual_context"].get("image_location", ""),
+            "description": latest["visual_context"].get("description", ""),
+            "items": items,
+        },
+        "timestamp": latest["timestamp"],
+        "first_seen": min(document.get("first_seen", document["timestamp"]) for document in scenes),
+        "scene_count": sum(document.get("scene_count", 1) for document in scenes),
+    }
@@ -0,0 +1,204 @@
+import asyncio
+import heapq
+import itertools
+import os
+import random
+from contextlib import asynccontextmanager
+
+from dotenv import load_dotenv
+from google.genai import errors
+
+load_dotenv()
+
+# Priority lanes, lower runs first. Interactive calls answer a waiting user (/conversation/*),
+# background calls are camera frames and transcriptions nobody is blocked on.
+INTERACTIVE = 0
+BACKGROUND = 1
+
+
+def is_rate_limited(error: Exception) -> bool:
+    return isinstance(error, errors.ClientError) and getattr(error, 'code', None) == 429
+
+
+async def _close(chunks):
+    if hasattr(chunks, "aclose"):
+        await chunks.aclose()
+
+
+async def _chain(first: list, chunks):
+    for chunk in first:
+        yield chunk
+    async for chunk in chunks:
+        yield chunk
+
+
+class RequestScheduler:
+    """Schedules calls to a rate-limited API.
+
+    Every call waits for a token from a client-side token bucket and for a free concurrency slot,
+    and waiting calls are admitted in priority order. The concurrency limit adapts to the upstream:
+    it is halved whenever a call is rate limited (429) and grows back by roughly one slot per
+    window of successful calls.
+    """
+
+    def __init__(self, rate: float, burst: int, max_concurrency: int, min_concurrency: int = 1,
+                 base_wait_time: float = 2.0):
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.base_wait_time = base_wait_time
+
+        self.limit = float(max_concurrency)
+        self.active = 0
+        self.rate_limited = 0
+
+        self._tokens = float(burst)
+        self._refilled_at = None
+        self._waiters = []
+        self._sequence = itertools.count()
+        self._wakeup = None
+
+    def _refill(self, now: float):
+        if self._refilled_at is not None:
+            self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+
+    def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        self._wakeup = None
+        self._refill(loop.time())
+
+        while self._waiters and self.active < int(self.limit):
+            _, _, future = self._waiters[0]
+            if future.done():  # the caller was cancelled while queued
+                heapq.heappop(self._waiters)
+                continue
+
+            if self._tokens < 1:
+                if self._wakeup is None:
+                    self._wakeup = loop.call_later((1 - self._tokens) / self.rate, self._dispatch)
+                return
+
+            heapq.heappop(self._waiters)
+            self._tokens -= 1
+            self.active += 1
+            future.set_result(None)
+
+    async def _acquire(self, priority: int):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), future))
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            # The slot may have been granted right before the cancellation landed
+            if future.done() and not future.cancelled():
+                self._release()
+            raise
+
+    def _release(self):
+        self.active -= 1
+        self._dispatch()
+
+    def _on_success(self):
+        self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+
+    def _on_rate_limited(self):
+        self.rate_limited += 1
+        self.limit = max(self.min_concurrency, self.limit / 2)
+        self._tokens = min(self._tokens, 0)
+
+    async def _admit(self, call, priority: int, max_retries: int):
+        """Runs a call in a slot, retrying it with exponential backoff when rate limited.
+
+        The slot is still held when the call succeeds, the caller releases it.
+        """
+        retry_count = 0
+        while True:
+            await self._acquire(priority)
+            try:
+                result = await call()
+            except Exception as e:
+                self._release()
+                if not is_rate_limited(e):
+                    raise
+                self._on_rate_limited()
+                if retry_count >= max_retries:
+                    raise
+            except BaseException:
+                self._release()
+                raise
+            else:
+                self._on_success()
+                return result
+
+            retry_count += 1
+            # Calculate wait time with exponential backoff and jitter
+            wait_time = self.base_wait_time * (2 ** (retry_count - 1)) + random.uniform(0, 1)
+            print(f"Rate limit exceeded. Retrying in {wait_time:.2f} seconds...")
+            await asyncio.sleep(wait_time)
+
+    async def run(self, call, priority: int = INTERACTIVE, max_retries: int = 3):
+        """Runs a call through the scheduler, retrying it with exponential backoff when rate limited.
+
+        Args:
+            call: A zero-argument function returning the awaitable to run.
+            priority: The lane of the call, INTERACTIVE or BACKGROUND.
+            max_retries: Maximum number of retries after a 429.
+
+        Returns:
+            The result of the call. The last error is raised once the retries are exhausted.
+        """
+        result = await self._admit(call, priority, max_retries)
+        self._release()
+        return result
+
+    @asynccontextmanager
+    async def stream(self, call, priority: int = INTERACTIVE, max_retries: int = 3):
+        """Runs a streaming call through the scheduler, holding its slot until the stream is closed.
+
+        Streaming clients may only send the request once the stream is first iterated, so the
+        stream is opened and its first chunk read under the same 429 retries as run.
+
+        Args:
+            call: A zero-argument function returning an awaitable of the async iterator of chunks.
+            priority: The lane of the call, INTERACTIVE or BACKGROUND.
+            max_retries: Maximum number of retries after a 429.
+
+        Yields:
+            An async iterator over all the chunks of the stream.
+        """
+        async def start():
+            chunks = await call()
+            try:
+                return chunks, [await anext(chunks)]
+            except StopAsyncIteration:
+                return chunks, []
+            except BaseException:
+                await _close(chunks)
+                raise
+
+        chunks, first = await self._admit(start, priority, max_retries)
+        try:
+            yield _chain(first, chunks)
+        finally:
+            try:
+                await _close(chunks)
+            finally:
+                self._release()
+
+    def stats(self) -> dict:
+        return {
+            "active": self.active,
+            "concurrency_limit": int(self.limit),
+            "queued": len(self._waiters),
+            "rate_limited": self.rate_limited,
+        }
+
+
+gemini_scheduler = RequestScheduler(
+    rate=float(os.getenv('GEMINI_REQUESTS_PER_SECOND', 5)),
+    burst=int(os.getenv('GEMINI_BURST', 10)),
+    max_concurrency=int(os.getenv('GEMINI_MAX_CONCURRENCY', 8)),
+)
@@ -0,0 +1,95 @@
+import math
+import re
+import time
+
+# How much a keyword match counts depending on where it was found
+FIELD_WEIGHTS = {
+    "name": 3.0,
+    "color": 1.5,
+    "location": 1.0,
+    "image_location": 1.0,
+    "description": 0.5,
+    "scene_description": 0.5,
+}
+
+# A scene seen this many hours ago gets half the recency boost of one seen just now
+RECENCY_HALF_LIFE_HOURS = 24.0
+
+STOPWORDS = {
+    "a", "an", "and", "are", "at", "by", "for", "from", "in", "is", "it", "its", "my", "near",
+    "next", "of", "on", "or", "the", "there", "to", "was", "where", "with",
+}
+
+_WORD = re.compile(r"[a-z0-9]+")
+
+
+def _normalize(word: str) -> str:
+    # Naive plural folding so "keys" finds "key" and the other way around
+    if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+        return word[:-1]
+    return word
+
+
+def tokenize(text: str) -> list[str]:
+    """Splits text into normalized search terms, dropping stopwords."""
+    return [_normalize(word) for word in _WORD.findall(text.lower()) if word not in STOPWORDS]
+
+
+def field_terms(visual_context: dict) -> dict[str, set[str]]:
+    """Returns the search terms of every searchable field of a visual context."""
+    terms = {field: set() for field in FIELD_WEIGHTS}
+    terms["image_location"].update(tokenize(visual_context.get("image_location", "")))
+    terms["scene_description"].update(tokenize(visual_context.get("description", "")))
+    for item in visual_context.get("items", []):
+        for field in ("name", "color", "location", "description"):
+            terms[field].update(tokenize(item.get(field, "")))
+    return terms
+
+
+def index_terms(visual_context: dict) -> list[str]:
+    """Returns every distinct search term of a visual context, as stored in its search_terms field."""
+    return sorted(set().union(*field_terms(visual_context).values()))
+
+
+def rank(documents: list[dict], query_terms: list[str], now: float = None) -> list[tuple[float, dict]]:
+    """Ranks scenes by relevance to the query terms and by recency.
+
+    Relevance sums, for every query term found in a scene, the weight of the best field it was
+    found in times the term's inverse document frequency among the candidates, so rare terms
+    count more than ones that appear everywhere. It is then scaled by a recency factor between
+    0.5 and 1 that halves its boost every RECENCY_HALF_LIFE_HOURS.
+
+    Args:
+        documents: The candidate scene documents.
+        query_terms: The normalized query terms.
+        now: The current unix timestamp.
+
+    Returns:
+        (score, document) pairs with a positive score, best first.
+    """
+    now = now or time.time()
+    query_terms = set(query_terms)
+    candidates = [(document, field_terms(document["visual_context"])) for document in documents]
+
+    document_frequency = {term: 0 for term in query_terms}
+    for _, terms in candidates:
+        all_terms = set().union(*terms.values())
+        for term in query_terms & all_terms:
+            document_frequency[term] += 1
+
+    ranked = []
+    for document, terms in candidates:
+        relevance = 0.0
+        for term in query_terms:
+            weight = max((FIELD_WEIGHTS[field] for field, values in terms.items() if term in values), default=0.0)
+            if weight:
+                relevance += weight * math.log(1 + len(candidates) / document_frequency[term])
+        if relevance <= 0:
+            continue
+
+        age_hours = max(0.0, now - document["timestamp"]) / 3600
+        recency = 0.5 + 0.5 * 0.5 ** (age_hours / RECENCY_HALF_LIFE_HOURS)
+        ranked.append((relevance * recency, document))
+
+    ranked.sort(key=lambda pair: pair[0], reverse=True)
+    return ranked
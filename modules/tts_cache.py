@@ -0,0 +1,229 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+
+from dotenv import load_dotenv
+
+from modules import eleven_labs
+
+load_dotenv()
+
+parent_dir = os.path.dirname((os.path.dirname(__file__)))
+CACHE_DIR = os.getenv('TTS_CACHE_DIR', os.path.join(parent_dir, "static", "tts_cache"))
+MAX_CACHE_BYTES = int(os.getenv('TTS_CACHE_MAX_BYTES', 200 * 1024 * 1024))
+READ_CHUNK_SIZE = 32 * 1024
+# Temp files untouched for this long are left over from a synthesis that never finished. A live one
+# is written to with every chunk, and other workers may be writing theirs into the same directory.
+STALE_TMP_SECONDS = 600
+
+
+def cache_key(text: str) -> str:
+    """Hashes everything that determines the synthesized audio: text, voice, model, format and voice settings."""
+    payload = {
+        "text": text,
+        "voice_id": eleven_labs.VOICE_ID,
+        "model_id": eleven_labs.MODEL_ID,
+        "output_format": eleven_labs.OUTPUT_FORMAT,
+        "voice_settings": eleven_labs.voice_settings.model_dump(),
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class _Flight:
+    """An upstream synthesis in progress. Every request for the same audio follows the same flight."""
+
+    def __init__(self):
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.followers = 0
+        self.task = None
+        self._changed = asyncio.Event()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def add(self, chunk: bytes):
+        self.chunks.append(chunk)
+        self._notify()
+
+    def finish(self, error: Exception = None):
+        self.done = True
+        self.error = error
+        self._notify()
+
+    async def follow(self):
+        i = 0
+        while True:
+            changed = self._changed
+            while i < len(self.chunks):
+                yield self.chunks[i]
+                i += 1
+            if self.done:
+                if self.error:
+                    raise self.error
+                return
+            await changed.wait()
+
+
+class TTSCache:
+    """An on-disk, content-addressed cache of synthesized speech with LRU eviction.
+
+    Cache hits are streamed from disk. Misses are synthesized once: concurrent requests for the
+    same audio follow a single upstream call, which is written to the cache when it completes.
+
+    Every worker process keeps its own index and size count of the shared directory, so max_bytes
+    (TTS_CACHE_MAX_BYTES) applies per worker.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.merged = 0
+        self._entries = OrderedDict()  # key -> size in bytes, least recently used first
+        self._size = 0
+        self._flights = {}
+
+        os.makedirs(cache_dir, exist_ok=True)
+        files = []
+        now = time.time()
+        for name in os.listdir(cache_dir):
+            path = os.path.join(cache_dir, name)
+            try:
+                stat = os.stat(path)
+                if name.endswith(".tmp"):
+                    if now - stat.st_mtime > STALE_TMP_SECONDS:
+                        os.remove(path)
+                elif name.endswith(".mp3"):
+                    files.append((stat.st_mtime, name[:-len(".mp3")], stat.st_size))
+            except FileNotFoundError:
+                pass  # renamed or evicted by another worker in the meantime
+        for _, key, size in sorted(files):
+            self._entries[key] = size
+            self._size += size
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.mp3")
+
+    def _add(self, key: str, size: int) -> list[str]:
+        """Indexes a new entry and evicts the least recently used ones over max_bytes.
+
+        Returns:
+            The paths of the evicted entries, for the caller to remove off the event loop.
+        """
+        self._entries[key] = size
+        self._size += size
+        evicted_paths = []
+        while self._size > self.max_bytes and len(self._entries) > 1:
+            evicted, evicted_size = self._entries.popitem(last=False)
+            self._size -= evicted_size
+            evicted_paths.append(self._path(evicted))
+        return evicted_paths
+
+    @staticmethod
+    def _remove(paths: list[str]):
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    async def _read(self, path: str):
+        # An entry evicted while it is being read stays readable through the open file
+        with open(path, "rb") as f:
+            while chunk := await asyncio.to_thread(f.read, READ_CHUNK_SIZE):
+                yield chunk
+
+    async def _fill(self, key: str, text: str, flight: _Flight):
+        # Like _read, all disk I/O runs on a worker thread. Followers get each chunk before it is written.
+        tmp_path = f"{self._path(key)}.{os.getpid()}.{id(flight)}.tmp"
+        try:
+            size = 0
+            f = await asyncio.to_thread(open, tmp_path, "wb")
+            try:
+                async for chunk in eleven_labs.synthesize(text):
+                    flight.add(chunk)
+                    size += len(chunk)
+                    await asyncio.to_thread(f.write, chunk)
+            finally:
+                await asyncio.to_thread(f.close)
+            await asyncio.to_thread(os.replace, tmp_path, self._path(key))
+            evicted = self._add(key, size)
+            flight.finish()
+        except BaseException as e:
+            await asyncio.to_thread(self._remove, [tmp_path])
+            flight.finish(e if isinstance(e, Exception) else ConnectionAbortedError("Speech synthesis cancelled"))
+            if not isinstance(e, Exception):
+                raise
+            return
+        finally:
+            self._flights.pop(key, None)
+        await asyncio.to_thread(self._remove, evicted)
+
+    async def _follow(self, flight: _Flight):
+        flight.followers += 1
+        try:
+            async for chunk in flight.follow():
+                yield chunk
+        finally:
+            flight.followers -= 1
+            # Nobody is listening anymore: stop paying for the upstream request
+            if flight.followers == 0 and not flight.done:
+                flight.task.cancel()
+
+    async def synthesize(self, text: str):
+        """Streams the speech audio of a text, from the cache when possible.
+
+        Args:
+            text: The text to speak.
+
+        Yields:
+            Chunks of MP3 audio.
+        """
+        key = cache_key(text)
+
+        if key in self._entries:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            path = self._path(key)
+            try:
+                os.utime(path)  # keeps the LRU order across restarts
+                async for chunk in self._read(path):
+                    yield chunk
+                return
+            except FileNotFoundError:
+                self._size -= self._entries.pop(key, 0)
+
+        flight = self._flights.get(key)
+        if flight is None:
+            self.misses += 1
+            flight = _Flight()
+            self._flights[key] = flight
+            flight.task = asyncio.create_task(self._fill(key, text, flight))
+        else:
+            self.merged += 1
+
+        async for chunk in self._follow(flight):
+            yield chunk
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses + self.merged
+        return {
+            "entries": len(self._entries),
+            "bytes": self._size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "merged": self.merged,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "in_flight": len(self._flights),
+        }
+
+
+cache = TTSCache(CACHE_DIR, MAX_CACHE_BYTES)
@@ -0,0 +1,214 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import spacy
+from dotenv import load_dotenv
+
+load_dotenv()
+
+parent_dir = os.path.dirname((os.path.dirname(__file__)))
+model_dir = os.path.join(parent_dir, "static", "en_core_web_md-3.8.0")
+
+with open(os.path.join(model_dir, "meta.json")) as meta_file:
+    meta = json.load(meta_file)
+
+# Tag stored next to persisted vectors; vectors written by a different model are ignored and recomputed.
+MODEL_TAG = f"{meta['lang']}_{meta['name']}-{meta['version']}"
+VECTOR_DIM = meta["vectors"]["width"]
+
+# "vectors" only tokenizes and looks words up in the memory-mapped static vectors table, which is all
+# Doc.vector uses. "pipeline" loads the full spaCy pipeline like before.
+VECTOR_MODE = os.getenv('VECTOR_MODE', 'vectors')
+MMAP_DIR = os.getenv('VECTOR_MMAP_DIR', os.path.join(parent_dir, "static", "vectors_mmap"))
+
+CACHE_SIZE = int(os.getenv('VECTOR_CACHE_SIZE', 20000))
+PIPE_BATCH_SIZE = int(os.getenv('VECTOR_PIPE_BATCH_SIZE', 256))
+
+# The spaCy pipeline runs on a single dedicated thread so uploads never block the event loop
+# and batches from concurrent requests don't fight over the same pipeline.
+executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="vectors")
+
+
+class VectorCache:
+    """A size-bounded LRU cache of text -> vector with hit/miss counters."""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, text: str):
+        with self._lock:
+            vector = self._entries.get(text)
+            if vector is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(text)
+            self.hits += 1
+            return vector
+
+    def put(self, text: str, vector: np.ndarray):
+        with self._lock:
+            self._entries[text] = vector
+            self._entries.move_to_end(text)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+class PipelineBackend:
+    """Computes Doc.vector with the full spaCy pipeline."""
+
+    def __init__(self):
+        self.nlp = spacy.load(model_dir, disable=["ner", "parser", "tagger"])
+
+    def vectors(self, texts: list[str]):
+        for doc in self.nlp.pipe(texts, batch_size=PIPE_BATCH_SIZE):
+            yield np.asarray(doc.vector, dtype=np.float32)
+
+
+class MmapBackend:
+    """Computes Doc.vector from a tokenizer and a memory-mapped export of the static vectors table.
+
+    The exported .npy files are opened read-only with mmap, so every worker on a host shares
+    the same pages through the page cache instead of holding its own copy of the table.
+    """
+
+    def __init__(self):
+        if _read_export_tag() != MODEL_TAG:
+            _export_vectors()
+
+        self.tokenizer = spacy.blank(meta["lang"]).tokenizer
+        self.data = np.load(os.path.join(MMAP_DIR, "vectors.npy"), mmap_mode="r")
+        self.keys = np.load(os.path.join(MMAP_DIR, "keys.npy"), mmap_mode="r")
+        self.rows = np.load(os.path.join(MMAP_DIR, "rows.npy"), mmap_mode="r")
+
+    def vectors(self, texts: list[str]):
+        for doc in self.tokenizer.pipe(texts, batch_size=PIPE_BATCH_SIZE):
+            if not len(doc):
+                yield np.zeros(VECTOR_DIM, dtype=np.float32)
+                continue
+
+            # Same as Doc.vector: the mean over all tokens, where out-of-vocabulary tokens count as zeros
+            orths = np.array([token.orth for token in doc], dtype=np.uint64)
+            positions = np.minimum(np.searchsorted(self.keys, orths), len(self.keys) - 1)
+            known = self.keys[positions] == orths
+            vector = np.zeros(VECTOR_DIM, dtype=np.float32)
+            if known.any():
+                vector = self.data[self.rows[positions[known]]].sum(axis=0, dtype=np.float32)
+            yield vector / len(doc)
+
+
+def _read_export_tag():
+    try:
+        with open(os.path.join(MMAP_DIR, "meta.json")) as export_meta:
+            return json.load(export_meta).get("model")
+    except (OSError, ValueError):
+        return None
+
+
+def _export_vectors():
+    """Exports the model's static vectors to .npy files that can be memory-mapped.
+
+    Each file is written under a temporary name and renamed into place, so workers racing on a
+    cold host never read a partial file. meta.json is written last and marks the export complete.
+    """
+    start = time.perf_counter()
+    vocab = spacy.load(model_dir, exclude=meta["components"]).vocab
+
+    keys = np.array(list(vocab.vectors.key2row.keys()), dtype=np.uint64)
+    rows = np.array(list(vocab.vectors.key2row.values()), dtype=np.int32)
+    order = np.argsort(keys)
+
+    os.makedirs(MMAP_DIR, exist_ok=True)
+    arrays = {
+        "vectors.npy": np.asarray(vocab.vectors.data, dtype=np.float32),
+        "keys.npy": keys[order],
+        "rows.npy": rows[order],
+    }
+    for name, array in arrays.items():
+        tmp_path = os.path.join(MMAP_DIR, f"{name}.{os.getpid()}.tmp")
+        with open(tmp_path, "wb") as tmp_file:
+            np.save(tmp_file, array)
+        os.replace(tmp_path, os.path.join(MMAP_DIR, name))
+
+    tmp_path = os.path.join(MMAP_DIR, f"meta.json.{os.getpid()}.tmp")
+    with open(tmp_path, "w") as tmp_file:
+        json.dump({"model": MODEL_TAG, "keys": len(keys), "rows": len(arrays["vectors.npy"])}, tmp_file)
+    os.replace(tmp_path, os.path.join(MMAP_DIR, "meta.json"))
+    print(f"Exported {len(keys)} vector keys to {MMAP_DIR} in {time.perf_counter() - start:.2f}s")
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    """Returns the vectorizer backend, loading it on first use."""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                start = time.perf_counter()
+                _backend = PipelineBackend() if VECTOR_MODE == "pipeline" else MmapBackend()
+                print(f"Loaded {VECTOR_MODE} vectorizer in {time.perf_counter() - start:.2f}s")
+    return _backend
+
+
+cache = VectorCache(CACHE_SIZE)
+
+
+def vectorize_sync(texts: list[str]) -> np.ndarray:
+    """Computes the spaCy document vector of every text.
+
+    Texts are deduplicated first, cached texts are served from the LRU, and the rest go through
+    the backend in a single batch.
+
+    Args:
+        texts: The strings to vectorize.
+
+    Returns:
+        A (len(texts), dim) float32 matrix, one row per input text in the same order.
+    """
+    found = {}
+    missing = []
+    for text in dict.fromkeys(texts):
+        vector = cache.get(text)
+        if vector is None:
+            missing.append(text)
+        else:
+            found[text] = vector
+
+    if missing:
+        for text, vector in zip(missing, get_backend().vectors(missing)):
+            cache.put(text, vector)
+            found[text] = vector
+
+    matrix = np.zeros((len(texts), VECTOR_DIM), dtype=np.float32)
+    for i, text in enumerate(texts):
+        matrix[i] = found[text]
+    return matrix
+
+
+async def vectorize(texts: list[str]) -> np.ndarray:
+    """Asynchronously computes the vector of every text on the vectorizer thread. See vectorize_sync."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, vectorize_sync, texts)
@@ -0,0 +1,93 @@
+import asyncio
+import os
+import re
+
+from modules import eleven_labs
+
+# A sentence ends at ., ! or ? followed by whitespace
+SENTENCE_END = re.compile(r'(?<=[.!?])\s+')
+# Sentences shorter than this are merged with the next one so we don't pay a TTS round trip for "Sure."
+MIN_SENTENCE_LENGTH = int(os.getenv('VOICE_MIN_SENTENCE_LENGTH', 20))
+# How many sentences may be synthesized ahead of the one currently being played
+MAX_PENDING_SENTENCES = int(os.getenv('VOICE_MAX_PENDING_SENTENCES', 3))
+
+
+async def split_sentences(chunks):
+    """Groups a stream of text chunks into sentences.
+
+    Args:
+        chunks: An async iterator of text chunks.
+
+    Yields:
+        Each sentence as soon as it is complete, and whatever text remains at the end.
+    """
+    buffer = ""
+    async for chunk in chunks:
+        buffer += chunk
+        *sentences, buffer = SENTENCE_END.split(buffer)
+
+        pending = ""
+        for sentence in sentences:
+            pending = f"{pending} {sentence}".strip()
+            if len(pending) >= MIN_SENTENCE_LENGTH:
+                yield pending
+                pending = ""
+        if pending:
+            buffer = f"{pending} {buffer}"
+
+    if buffer.strip():
+        yield buffer.strip()
+
+
+async def _synthesize_into(sentence: str, previous_text: str, chunks: asyncio.Queue):
+    """Synthesizes one sentence into a queue of audio chunks, ending it with None."""
+    try:
+        async for chunk in eleven_labs.synthesize(sentence, previous_text):
+            chunks.put_nowait(chunk)
+    except Exception as e:
+        # Losing one sentence is better than cutting off the rest of the answer
+        print(f"Error synthesizing sentence: {str(e)}")
+    finally:
+        chunks.put_nowait(None)
+
+
+async def speak(sentences):
+    """Turns a stream of sentences into one continuous MP3 stream.
+
+    Every sentence is sent to ElevenLabs as soon as it arrives, while the audio of the earlier
+    sentences is still being played, and the audio is yielded in sentence order. At most
+    MAX_PENDING_SENTENCES are synthesized ahead of playback.
+
+    Args:
+        sentences: An async iterator of sentences.
+
+    Yields:
+        Chunks of MP3 audio.
+    """
+    pending = asyncio.Queue(maxsize=MAX_PENDING_SENTENCES)
+    tasks = []
+
+    async def produce():
+        previous_text = None
+        try:
+            async for sentence in sentences:
+                chunks = asyncio.Queue()
+                tasks.append(asyncio.create_task(_synthesize_into(sentence, previous_text, chunks)))
+                previous_text = sentence
+                await pending.put(chunks)
+        except Exception as e:
+            await pending.put(e)
+            return
+        await pending.put(None)
+
+    producer = asyncio.create_task(produce())
+    try:
+        while (chunks := await pending.get()) is not None:
+            if isinstance(chunks, Exception):
+                raise chunks
+            while (chunk := await chunks.get()) is not None:
+                yield chunk
+    finally:
+        producer.cancel()
+        for task in tasks:
+            task.cancel()
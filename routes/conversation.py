@@ -1,27 +1,77 @@
 from fastapi import APIRouter, HTTPException, Depends, status, File, UploadFile, Form
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from modules import database, gemini
+from typing import Literal
+from modules import database, gemini, voice
+from utils import metrics
 import io
+import json
+import time
 import asyncio
 from io import BytesIO
 
 router = APIRouter()
 
+# Unknown values are rejected by validation, they would otherwise each add a metrics key
+ContextMode = Literal["tools", "prefetch"]
+
 class TextPromptRequest(BaseModel):
     user_id: str
     text_query: str
+    context_mode: ContextMode | None = None
 
 @router.post("/conversation/text", status_code=status.HTTP_200_OK)
 async def text_prompt(request: TextPromptRequest):
     try:
         print(request)
-        return await gemini.generate_response(user_id=request.user_id, text_query=request.text_query)
+        return await gemini.generate_response(user_id=request.user_id, text_query=request.text_query,
+                                              context_mode=request.context_mode)
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Error processing text prompt: {str(e)}"
         )
 
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def _stream_answer(user_id: str, chunks):
+    """Sends the answer chunks as Server-Sent Events and saves the full answer once it is complete.
+
+    An answer cut off midway ends with an "error" event instead of "done" and is not saved.
+    """
+    answer = []
+    try:
+        async for text in chunks:
+            answer.append(text)
+            yield _sse("message", {"text": text})
+    except Exception as e:
+        yield _sse("error", {"detail": f"The answer was interrupted: {str(e)}", "text": "".join(answer)})
+        return
+
+    response_text = "".join(answer)
+    await database.save_message(user_id, "assistant", response_text)
+    yield _sse("done", {"text": response_text})
+
+def _event_stream(user_id: str, chunks) -> StreamingResponse:
+    return StreamingResponse(
+        _stream_answer(user_id, chunks),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@router.post("/conversation/text/stream", status_code=status.HTTP_200_OK)
+async def text_prompt_stream(request: TextPromptRequest):
+    """Streams the answer to a text question as Server-Sent Events.
+
+    Each "message" event carries a chunk of the answer as {"text": ...}, and a final "done" event
+    carries the full answer. If generation fails midway, the stream ends with an "error" event
+    carrying {"detail": ..., "text": the partial answer} instead.
+    """
+    chunks = gemini.generate_response_stream(user_id=request.user_id, text_query=request.text_query,
+                                             context_mode=request.context_mode)
+    return _event_stream(request.user_id, chunks)
+
 async def handle_transcript_task(file: BytesIO, user_id: str):
     try:
         transcription_task = await gemini.generate_audio_transcription(audio_file=file)
@@ -33,7 +83,7 @@ async def handle_transcript_task(file: BytesIO, user_id: str):
         )
 
 @router.post("/conversation/audio", status_code=status.HTTP_200_OK)
-async def audio_prompt(user_id: str = Form(...), audio_file: UploadFile = File(...)):
+async def audio_prompt(user_id: str = Form(...), audio_file: UploadFile = File(...), context_mode: ContextMode | None = Form(None)):
     try:
         contents = await audio_file.read()
         
@@ -42,7 +92,7 @@ async def audio_prompt(user_id: str = Form(...), audio_file: UploadFile = File(.
         transcription_audio = io.BytesIO(contents)
         
         # Run both tasks concurrently
-        response_task = await gemini.generate_response(user_id, audio_file=response_audio)
+        response_task = await gemini.generate_response(user_id, audio_file=response_audio, context_mode=context_mode)
         asyncio.create_task(handle_transcript_task(transcription_audio, user_id))
         await database.save_message(user_id, "assistant", response_task)
         
@@ -53,6 +103,60 @@ async def audio_prompt(user_id: str = Form(...), audio_file: UploadFile = File(.
             detail=f"Error processing audio prompt: {str(e)}"
         )
     
+@router.post("/conversation/audio/stream", status_code=status.HTTP_200_OK)
+async def audio_prompt_stream(user_id: str = Form(...), audio_file: UploadFile = File(...), context_mode: ContextMode | None = Form(None)):
+    """Streams the answer to an audio question as Server-Sent Events, see text_prompt_stream."""
+    contents = await audio_file.read()
+
+    response_audio = io.BytesIO(contents)
+    transcription_audio = io.BytesIO(contents)
+
+    asyncio.create_task(handle_transcript_task(transcription_audio, user_id))
+    chunks = gemini.generate_response_stream(user_id, audio_file=response_audio, context_mode=context_mode)
+    return _event_stream(user_id, chunks)
+
+async def _speak_answer(user_id: str, chunks):
+    """Speaks the answer sentence by sentence while it is generated and saves it once complete."""
+    start = time.perf_counter()
+    answer = []
+
+    async def answer_text():
+        # An interrupted answer is not saved, and its error aborts the audio response so the client
+        # can tell it was cut off
+        async for text in chunks:
+            answer.append(text)
+            yield text
+        await database.save_message(user_id, "assistant", "".join(answer))
+
+    first_byte = True
+    async for audio in voice.speak(voice.split_sentences(answer_text())):
+        if first_byte:
+            metrics.record_latency("voice.first_byte", time.perf_counter() - start)
+            first_byte = False
+        yield audio
+
+    metrics.record_latency("voice.total", time.perf_counter() - start)
+
+@router.post("/conversation/voice", status_code=status.HTTP_200_OK)
+async def voice_prompt(user_id: str = Form(...), audio_file: UploadFile = File(...), context_mode: ContextMode | None = Form(None)):
+    """Answers an audio question with speech.
+
+    The answer is streamed from Gemini, split into sentences as they complete and each sentence is
+    synthesized while the next ones are still being generated. The audio comes back as one MP3 stream.
+    """
+    contents = await audio_file.read()
+
+    response_audio = io.BytesIO(contents)
+    transcription_audio = io.BytesIO(contents)
+
+    asyncio.create_task(handle_transcript_task(transcription_audio, user_id))
+    chunks = gemini.generate_response_stream(user_id, audio_file=response_audio, context_mode=context_mode)
+    return StreamingResponse(
+        _speak_answer(user_id, chunks),
+        media_type="audio/mpeg",
+        headers={"Content-Disposition": "attachment; filename=output.mp3"}
+    )
+
 @router.get("/conversation/clear", status_code=status.HTTP_200_OK)
 async def clear_conversation(user_id: str = Form(...)):
     try:
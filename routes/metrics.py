@@ -0,0 +1,21 @@
+from fastapi import APIRouter, status
+from modules import conversation_cache, database, scheduler, tts_cache, vectors
+from utils import metrics
+
+router = APIRouter()
+
+# Returns request latency percentiles and the state of the internal queues and caches
+@router.get("/metrics", status_code=status.HTTP_200_OK)
+async def get_metrics():
+    return {
+        "latency": metrics.latency_summary(),
+        "counters": metrics.counters(),
+        "gemini_scheduler": scheduler.gemini_scheduler.stats(),
+        "vector_cache": vectors.cache.stats(),
+        "tts_cache": tts_cache.cache.stats(),
+        "dedup_queue": database.dedup_queue.stats(),
+        "registry_queue": database.registry_queue.stats(),
+        "conversation_cache": conversation_cache.cache.stats(),
+        "conversation_writes": database.conversation_buffer.stats(),
+        "visual_writes": database.visual_buffer.stats(),
+    }
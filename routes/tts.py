@@ -1,39 +1,44 @@
-from io import BytesIO
+import time
+from contextlib import aclosing
 
-from fastapi import APIRouter, status
-from modules import eleven_labs
-from elevenlabs import AsyncElevenLabs, VoiceSettings
+from fastapi import APIRouter, Request, status
+from modules import tts_cache
 from fastapi.responses import StreamingResponse
-import os
+from utils import metrics
 
 router = APIRouter()
 
-@router.get("/tts/generate", status_code=status.HTTP_200_OK)
-async def tts(text: str):
-    client: AsyncElevenLabs = await eleven_labs.get_eleven_client()
-    response = client.text_to_speech.convert(
-        voice_id=os.getenv('ELEVEN_LABS_VOICE_ID'),
-        output_format="mp3_22050_32",
-        text=text,
-        model_id="eleven_flash_v2_5",
-        voice_settings=VoiceSettings(
-            stability=0.0,
-            similarity_boost=1.0,
-            style=0.0,
-            use_speaker_boost=True,
-            speed=1.05,
-        ),
-    )
+async def _forward_audio(request: Request, audio, first_chunk: bytes, start: float):
+    """Forwards the audio chunks to the client as they arrive from the cache or ElevenLabs.
+
+    Chunks are only pulled from upstream once the previous one has been sent, and the upstream
+    request is closed as soon as the client disconnects.
+    """
+    async with aclosing(audio):
+        if first_chunk:
+            yield first_chunk
+        async for chunk in audio:
+            if await request.is_disconnected():
+                print("Client disconnected, cancelling speech synthesis")
+                return
+            yield chunk
 
-    audio_data = BytesIO()
-    async for chunk in response:
-        if chunk:
-            audio_data.write(chunk)
+    metrics.record_latency("tts.total", time.perf_counter() - start)
+
+@router.get("/tts/generate", status_code=status.HTTP_200_OK)
+async def tts(text: str, request: Request):
+    start = time.perf_counter()
+    audio = tts_cache.cache.synthesize(text)
 
-    audio_data.seek(0)  # rewind to start
+    # Wait for the first chunk before answering, so upstream errors still fail the request
+    try:
+        first_chunk = await anext(audio)
+    except StopAsyncIteration:
+        first_chunk = b""
+    metrics.record_latency("tts.first_byte", time.perf_counter() - start)
 
     return StreamingResponse(
-        audio_data,
+        _forward_audio(request, audio, first_chunk, start),
         media_type="audio/mpeg",
         headers={"Content-Disposition": "attachment; filename=output.mp3"}
     )
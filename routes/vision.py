@@ -1,12 +1,27 @@
-from fastapi import APIRouter, HTTPException, status
+from fastapi import APIRouter, HTTPException, status, File, UploadFile, Form
 from pydantic import BaseModel
-from modules import database, gemini
+from modules import database, frames, gemini
+from utils import metrics
+from utils.write_buffer import DiscardedError
 import io
+import os
+import time
+import asyncio
 import base64
-from PIL import Image, ImageStat
+from PIL import Image, ImageOps, ImageStat
 
 router = APIRouter()
 
+# Frames are downscaled so their longest edge is at most this many pixels before they are sent to Gemini
+MAX_IMAGE_EDGE = int(os.getenv('VISION_MAX_IMAGE_EDGE', 1024))
+# JPEG or WEBP
+IMAGE_FORMAT = os.getenv('VISION_IMAGE_FORMAT', 'JPEG').upper()
+IMAGE_QUALITY = int(os.getenv('VISION_IMAGE_QUALITY', 80))
+# Brightness and contrast checks run on a thumbnail of at most this size instead of the full frame
+VALIDATION_SIZE = 64
+# Formats Gemini accepts as they are
+SUPPORTED_MIME_TYPES = {'image/png', 'image/jpeg', 'image/webp', 'image/heic', 'image/heif'}
+
 # Handles visual context saving and retrieval, API should receive an image and then call get_visual_context
 class ImageUploadRequest(BaseModel):
     user_id: str
@@ -29,44 +44,155 @@ async def upload_image(request: ImageUploadRequest):
     try:
         # Decode base64 image
         try:
-            image_data = base64.b64decode(request.image_base64)
+            image_data = await asyncio.to_thread(base64.b64decode, request.image_base64)
         except Exception:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="Invalid base64 image data"
             )
-        
-        # Validate image before processing
-        image_bytes = io.BytesIO(image_data)
-        if not is_valid_image(image_bytes):
-            return {
-                "message": "Image appears to be a black screen or solid color. Please ensure your camera is uncovered.",
-                "visual_context": {
-                    "image_location": "Unknown",
-                    "description": "The image appears to be a black screen or solid color. Please ensure your camera is uncovered.",
-                    "items": []
-                }
-            }
-        
-        # Reset the BytesIO position after validation
-        image_bytes.seek(0)
-        
-        # Process the image using gemini
-        visual_context = await gemini.get_visual_context(image_bytes)
-        
-        # Save the visual context to the database
-        await database.save_visual_context(request.user_id, visual_context)
-        
-        return {
-            "message": "Image processed successfully",
-            "visual_context": visual_context
-        }
+
+        return await process_frame(request.user_id, image_data)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Error processing image: {str(e)}"
         )
 
+@router.post("/vision/upload/binary", response_model=VisualContextResponse, status_code=status.HTTP_200_OK)
+async def upload_image_binary(user_id: str = Form(...), image_file: UploadFile = File(...)):
+    """Upload an image as a multipart file and get visual context
+
+    Same as /vision/upload without the base64 overhead.
+
+    Args:
+        user_id: The ID of the user.
+        image_file: The image file.
+
+    Returns:
+        A dictionary containing the visual context
+    """
+    try:
+        image_data = await image_file.read()
+        return await process_frame(user_id, image_data)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Error processing image: {str(e)}"
+        )
+
+async def process_frame(user_id: str, image_data: bytes) -> dict:
+    """Validates a camera frame, gets its visual context and saves it.
+
+    Args:
+        user_id: The ID of the user.
+        image_data: The raw image bytes.
+
+    Returns:
+        A dictionary containing the visual context
+    """
+    # Validate image before processing
+    if not await asyncio.to_thread(is_valid_image, io.BytesIO(image_data)):
+        return {
+            "message": "Image appears to be a black screen or solid color. Please ensure your camera is uncovered.",
+            "visual_context": {
+                "image_location": "Unknown",
+                "description": "The image appears to be a black screen or solid color. Please ensure your camera is uncovered.",
+                "items": []
+            }
+        }
+
+    # Near-identical to a frame we just processed: reuse its scene instead of calling Gemini
+    try:
+        frame_hash = await asyncio.to_thread(frames.dhash, image_data)
+    except Exception as e:
+        print(f"Error hashing image: {str(e)}")
+        frame_hash = None
+
+    if frame_hash is not None:
+        frame = frames.recent_frames.find(user_id, frame_hash)
+        if frame:
+            if await database.touch_visual_context(frame["scene_id"]):
+                metrics.increment("vision.frames_deduplicated")
+                return {
+                    "message": "Image processed successfully",
+                    "visual_context": frame["visual_context"]
+                }
+            # The scene was deleted in the meantime
+            frames.recent_frames.forget(user_id, frame)
+
+    # Downscale and re-encode the frame off the event loop
+    start = time.perf_counter()
+    processed_data, mime_type = await asyncio.to_thread(preprocess_image, image_data)
+    metrics.record_latency("vision.preprocess", time.perf_counter() - start)
+    metrics.increment("vision.bytes_received", len(image_data))
+    metrics.increment("vision.bytes_sent", len(processed_data))
+
+    # Process the image using gemini
+    start = time.perf_counter()
+    visual_context = await gemini.get_visual_context(io.BytesIO(processed_data), mime_type)
+    metrics.record_latency("vision.gemini", time.perf_counter() - start)
+
+    # Save the visual context to the database
+    try:
+        scene_id = await database.save_visual_context(user_id, visual_context)
+    except DiscardedError:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="The visual history was cleared while this image was being processed"
+        )
+    if frame_hash is not None:
+        frames.recent_frames.add(user_id, frame_hash, scene_id, visual_context)
+
+    return {
+        "message": "Image processed successfully",
+        "visual_context": visual_context
+    }
+
+def preprocess_image(image_data: bytes) -> tuple[bytes, str]:
+    """
+    Prepares a camera frame for vision inference.
+
+    The real format is detected from the data, EXIF rotation is applied, the frame is downscaled to
+    MAX_IMAGE_EDGE and re-encoded as IMAGE_FORMAT. If that doesn't make it smaller, the original is
+    kept with its real MIME type.
+
+    Args:
+        image_data: The raw image bytes.
+
+    Returns:
+        tuple: The bytes to send and their MIME type.
+    """
+    try:
+        img = Image.open(io.BytesIO(image_data))
+        source_mime_type = Image.MIME.get(img.format)
+        resized = max(img.size) > MAX_IMAGE_EDGE
+
+        # JPEG frames can be decoded at a reduced scale straight from the DCT, which is much cheaper
+        if img.format == 'JPEG':
+            img.draft('RGB', (MAX_IMAGE_EDGE, MAX_IMAGE_EDGE))
+
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((MAX_IMAGE_EDGE, MAX_IMAGE_EDGE))
+        if img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+
+        output = io.BytesIO()
+        img.save(output, format=IMAGE_FORMAT, quality=IMAGE_QUALITY)
+        processed_data = output.getvalue()
+
+        if not resized and source_mime_type in SUPPORTED_MIME_TYPES and len(processed_data) >= len(image_data):
+            return image_data, source_mime_type
+        return processed_data, Image.MIME[IMAGE_FORMAT]
+
+    except Exception as e:
+        print(f"Error preprocessing image: {str(e)}")
+        # Send it as it is and let Gemini decide, like before preprocessing existed
+        return image_data, 'image/png'
+
 def is_valid_image(image_bytes):
     """
     Check if an image is valid (not a black screen or solid color).
@@ -80,6 +206,10 @@ def is_valid_image(image_bytes):
     try:
         # Open the image
         img = Image.open(image_bytes)
+
+        # The statistics don't need megapixels: decode JPEGs at a reduced scale and shrink the rest
+        img.draft('RGB', (VALIDATION_SIZE, VALIDATION_SIZE))
+        img.thumbnail((VALIDATION_SIZE, VALIDATION_SIZE))
         
         # Convert to RGB if not already
         if img.mode != 'RGB':
@@ -128,6 +258,7 @@ def is_valid_image(image_bytes):
 async def clear_vision(user_id: str):
     try:
         await database.wipe_visual_history(user_id)
+        frames.recent_frames.clear(user_id)
         return {"message": "Visual history cleared successfully"}
     except Exception as e:
         raise HTTPException(
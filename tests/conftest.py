@@ -0,0 +1,10 @@
+import os
+
+# modules.database names its collections and the API clients read their keys from the environment
+# at import. Nothing here connects.
+os.environ.setdefault("MONGODB_URI", "mongodb://localhost:27017")
+os.environ.setdefault("DATABASE_NAME", "foresight_test")
+os.environ.setdefault("VISUAL_COLLECTION_NAME", "visual_contexts")
+os.environ.setdefault("CONVERSATION_COLLECTION_NAME", "conversations")
+os.environ.setdefault("GEMINI_API_KEY", "test")
+os.environ.setdefault("ELEVENLABS_API_KEY", "test")
@@ -0,0 +1,48 @@
+import asyncio
+
+from modules import gemini
+from routes import conversation
+
+
+def collect(events):
+    async def main():
+        return [event async for event in events]
+    return asyncio.run(main())
+
+
+def test_interrupted_answer_ends_with_an_error_event_and_is_not_saved(monkeypatch):
+    saved = []
+
+    async def save_message(user_id, role, content):
+        saved.append(content)
+
+    async def chunks():
+        yield "The keys are"
+        raise gemini.StreamInterrupted("connection reset")
+
+    monkeypatch.setattr(conversation.database, "save_message", save_message)
+
+    events = collect(conversation._stream_answer("u", chunks()))
+
+    assert events[0].startswith("event: message")
+    assert events[-1].startswith("event: error")
+    assert '"text": "The keys are"' in events[-1]
+    assert saved == []
+
+
+def test_complete_answer_is_saved_and_ends_with_done(monkeypatch):
+    saved = []
+
+    async def save_message(user_id, role, content):
+        saved.append(content)
+
+    async def chunks():
+        yield "The keys are "
+        yield "on the hook."
+
+    monkeypatch.setattr(conversation.database, "save_message", save_message)
+
+    events = collect(conversation._stream_answer("u", chunks()))
+
+    assert events[-1].startswith("event: done")
+    assert saved == ["The keys are on the hook."]
@@ -0,0 +1,19 @@
+from modules import database
+
+
+def test_classic_plan():
+    plan = {"stage": "LIMIT", "inputStage": {"stage": "FETCH", "inputStage": {"stage": "IXSCAN"}}}
+    assert database._plan_stages(plan) == ["LIMIT", "FETCH", "IXSCAN"]
+
+
+def test_slot_based_plan():
+    plan = {"queryPlan": {"stage": "FETCH", "inputStage": {"stage": "IXSCAN"}}, "slotBasedPlan": {"stages": "..."}}
+    assert database._plan_stages(plan) == ["FETCH", "IXSCAN"]
+
+
+def test_sharded_plan():
+    plan = {"stage": "SHARD_MERGE", "shards": [
+        {"shardName": "a", "winningPlan": {"queryPlan": {"stage": "COLLSCAN"}}},
+        {"shardName": "b", "winningPlan": {"stage": "FETCH", "inputStage": {"stage": "IXSCAN"}}},
+    ]}
+    assert database._plan_stages(plan) == ["SHARD_MERGE", "COLLSCAN", "FETCH", "IXSCAN"]
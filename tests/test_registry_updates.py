@@ -0,0 +1,27 @@
+import asyncio
+
+from modules import database
+
+
+def test_wipe_waits_for_the_running_registry_pass_and_stops_it(monkeypatch):
+    log = []
+
+    async def update_object_registry(document):
+        log.append(("start", document["_id"]))
+        await asyncio.sleep(0.05)
+        log.append(("end", document["_id"]))
+
+    monkeypatch.setattr(database, "_update_object_registry", update_object_registry)
+
+    async def main():
+        database._registry_pending["u"] = [{"_id": 1, "user_id": "u"}, {"_id": 2, "user_id": "u"}]
+        registry_pass = asyncio.create_task(database._update_registry_for_user("u", 2))
+        await asyncio.sleep(0.01)
+
+        await database._cancel_registry_updates("u")
+        log.append("wiped")
+        await registry_pass
+
+    asyncio.run(main())
+    assert log == [("start", 1), ("end", 1), "wiped"]
+    assert "u" not in database._registry_passes
@@ -0,0 +1,27 @@
+from modules import retention
+
+
+def scene(scene_id, timestamp, location, items):
+    return {"_id": scene_id, "timestamp": timestamp, "visual_context": {
+        "image_location": location, "description": f"scene {scene_id}", "items": items}}
+
+
+def test_merge_scenes_keeps_the_latest_sighting_of_every_item():
+    old = scene(1, 100, "the kitchen", [{"name": "mug", "color": "red", "location": "sink"}])
+    new = scene(2, 200, "Kitchen", [{"name": "mugs", "color": "red", "location": "table"}])
+
+    merged = retention.merge_scenes(None, [old, new])
+
+    assert retention.location_key(old["visual_context"]) == retention.location_key(new["visual_context"])
+    assert merged["visual_context"]["items"] == [{"name": "mugs", "color": "red", "location": "table"}]
+    assert merged["visual_context"]["description"] == "scene 2"
+    assert (merged["timestamp"], merged["first_seen"], merged["scene_count"]) == (200, 100, 2)
+
+
+def test_merge_scenes_skips_scenes_already_merged():
+    first = scene(1, 100, "kitchen", [{"name": "mug", "color": "red", "location": "sink"}])
+    second = scene(2, 200, "kitchen", [{"name": "keys", "color": "", "location": "hook"}])
+    summary = {**retention.merge_scenes(None, [first]), "merged_ids": [1]}
+
+    assert retention.merge_scenes(summary, [first]) is None
+    assert retention.merge_scenes(summary, [first, second])["scene_count"] == 2
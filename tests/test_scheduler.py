@@ -0,0 +1,64 @@
+import asyncio
+
+import pytest
+from google.genai import errors
+
+from modules.scheduler import RequestScheduler
+
+
+def rate_limited():
+    return errors.ClientError(429, {"error": {"code": 429, "message": "quota", "status": "RESOURCE_EXHAUSTED"}})
+
+
+def lazy_stream(chunks, error=None):
+    """Like the SDK's streams: nothing is sent until the stream is first iterated."""
+    async def open_stream():
+        async def iterate():
+            if error is not None:
+                raise error
+            for chunk in chunks:
+                yield chunk
+        return iterate()
+    return open_stream
+
+
+def test_stream_holds_its_slot_until_closed():
+    async def main():
+        scheduler = RequestScheduler(rate=100, burst=10, max_concurrency=4)
+        async with scheduler.stream(lazy_stream(["a", "b"])) as stream:
+            assert scheduler.active == 1
+            assert [chunk async for chunk in stream] == ["a", "b"]
+            assert scheduler.active == 1
+        assert scheduler.active == 0
+
+    asyncio.run(main())
+
+
+def test_stream_retries_a_429_raised_on_first_iteration():
+    async def main():
+        scheduler = RequestScheduler(rate=100, burst=10, max_concurrency=4, base_wait_time=0)
+        attempts = []
+
+        async def open_stream():
+            attempts.append(1)
+            error = rate_limited() if len(attempts) == 1 else None
+            return await lazy_stream(["ok"], error)()
+
+        async with scheduler.stream(open_stream) as stream:
+            assert [chunk async for chunk in stream] == ["ok"]
+        assert len(attempts) == 2
+        assert scheduler.rate_limited == 1
+        assert scheduler.active == 0
+
+    asyncio.run(main())
+
+
+def test_stream_releases_its_slot_when_retries_run_out():
+    async def main():
+        scheduler = RequestScheduler(rate=100, burst=10, max_concurrency=4, base_wait_time=0)
+        with pytest.raises(errors.ClientError):
+            async with scheduler.stream(lazy_stream([], rate_limited()), max_retries=1):
+                pass
+        assert scheduler.active == 0
+
+    asyncio.run(main())
@@ -0,0 +1,47 @@
+import asyncio
+import os
+
+from modules import eleven_labs, tts_cache
+
+
+def fake_synthesize(chunks):
+    calls = []
+
+    async def synthesize(text):
+        calls.append(text)
+        for chunk in chunks:
+            await asyncio.sleep(0)
+            yield chunk
+    return synthesize, calls
+
+
+def test_miss_is_written_to_disk_and_served_from_it_afterwards(tmp_path, monkeypatch):
+    synthesize, calls = fake_synthesize([b"ab", b"cd"])
+    monkeypatch.setattr(eleven_labs, "synthesize", synthesize)
+    cache = tts_cache.TTSCache(str(tmp_path), max_bytes=1024)
+
+    async def main():
+        first = b"".join([chunk async for chunk in cache.synthesize("hello")])
+        second = b"".join([chunk async for chunk in cache.synthesize("hello")])
+        return first, second
+
+    assert asyncio.run(main()) == (b"abcd", b"abcd")
+    assert calls == ["hello"]
+    assert cache.stats()["hits"] == 1
+    assert os.listdir(tmp_path) == [f"{tts_cache.cache_key('hello')}.mp3"]
+
+
+def test_filling_past_max_bytes_evicts_the_oldest_entry(tmp_path, monkeypatch):
+    synthesize, _ = fake_synthesize([b"x" * 10])
+    monkeypatch.setattr(eleven_labs, "synthesize", synthesize)
+    cache = tts_cache.TTSCache(str(tmp_path), max_bytes=15)
+
+    async def main():
+        for text in ["first", "second"]:
+            async for _ in cache.synthesize(text):
+                pass
+            await asyncio.sleep(0.05)  # the eviction runs after the last chunk is out
+
+    asyncio.run(main())
+    assert os.listdir(tmp_path) == [f"{tts_cache.cache_key('second')}.mp3"]
+    assert cache.stats()["bytes"] == 10
@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+
+from modules import vectors
+
+
+class StubBackend:
+    """Returns a distinct constant vector per text and records every batch it was asked for."""
+
+    def __init__(self):
+        self.batches = []
+
+    def vectors(self, texts):
+        self.batches.append(list(texts))
+        for text in texts:
+            yield np.full(vectors.VECTOR_DIM, float(len(text)), dtype=np.float32)
+
+
+@pytest.fixture
+def backend(monkeypatch):
+    stub = StubBackend()
+    monkeypatch.setattr(vectors, "_backend", stub)
+    monkeypatch.setattr(vectors, "cache", vectors.VectorCache(100))
+    return stub
+
+
+def test_vectorize_sync_maps_every_uncached_text(backend):
+    texts = ["a", "bb", "ccc", "bb"]
+
+    matrix = vectors.vectorize_sync(texts)
+
+    assert matrix.shape == (4, vectors.VECTOR_DIM)
+    assert [row[0] for row in matrix] == [1.0, 2.0, 3.0, 2.0]
+    assert backend.batches == [["a", "bb", "ccc"]]
+
+
+def test_vectorize_sync_only_sends_cache_misses_to_the_backend(backend):
+    vectors.vectorize_sync(["mug", "kitchen"])
+
+    matrix = vectors.vectorize_sync(["kitchen", "red mug", "mug"])
+
+    assert [row[0] for row in matrix] == [7.0, 7.0, 3.0]
+    assert backend.batches == [["mug", "kitchen"], ["red mug"]]
@@ -0,0 +1,92 @@
+import asyncio
+
+import pytest
+
+from utils.write_buffer import DiscardedError, WriteBuffer
+
+
+class FakeCollection:
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.documents = []
+        self.batches = []
+
+    async def insert_many(self, documents, ordered=True):
+        await asyncio.sleep(self.delay)
+        self.batches.append(len(documents))
+        self.documents.extend(documents)
+
+    async def insert_one(self, document):
+        self.documents.append(document)
+
+    async def delete_many(self, query):
+        self.documents = [document for document in self.documents if document["user_id"] != query["user_id"]]
+
+
+def test_documents_are_batched_and_flushed_on_stop():
+    async def main():
+        collection = FakeCollection()
+        buffer = WriteBuffer("test", collection, max_batch=3, max_delay=10)
+        buffer.start()
+        for i in range(7):
+            await buffer.add({"_id": i, "user_id": "u"})
+        assert len(buffer.pending("u")) == 7
+        await buffer.stop()
+        assert collection.batches == [3, 3, 1]
+        assert buffer.pending("u") == []
+
+    asyncio.run(main())
+
+
+def test_discard_waits_for_the_batch_being_written():
+    async def main():
+        collection = FakeCollection(delay=0.05)
+        buffer = WriteBuffer("test", collection, max_batch=1, max_delay=0)
+        buffer.start()
+        await buffer.add({"_id": 1, "user_id": "u"})
+        await asyncio.sleep(0.01)  # the batch is now being written
+
+        await buffer.discard("u")
+        await collection.delete_many({"user_id": "u"})
+        await asyncio.sleep(0.1)
+
+        assert collection.documents == []
+        await buffer.stop()
+
+    asyncio.run(main())
+
+
+def test_stop_fails_writers_it_could_not_flush():
+    async def main():
+        buffer = WriteBuffer("test", FakeCollection(delay=10), max_batch=1, max_delay=0)
+        buffer.start()
+        writes = [asyncio.create_task(buffer.write({"_id": i, "user_id": "u"})) for i in range(2)]
+        await asyncio.sleep(0.01)
+
+        await buffer.stop(timeout=0.05)
+
+        for write in writes:
+            with pytest.raises(ConnectionAbortedError):
+                await write
+
+    asyncio.run(main())
+
+
+def test_discard_fails_the_writers_of_dropped_documents():
+    async def main():
+        collection = FakeCollection()
+        buffer = WriteBuffer("test", collection, max_batch=10, max_delay=10)
+        buffer.start()
+        dropped = asyncio.create_task(buffer.write({"_id": 1, "user_id": "u"}))
+        kept = asyncio.create_task(buffer.write({"_id": 2, "user_id": "v"}))
+        await asyncio.sleep(0)
+
+        await buffer.discard("u")
+        await buffer.stop()
+
+        with pytest.raises(DiscardedError):
+            await dropped
+        await kept
+        assert [document["_id"] for document in collection.documents] == [2]
+
+    asyncio.run(main())
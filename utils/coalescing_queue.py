@@ -0,0 +1,92 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+from utils import metrics
+
+
+class CoalescingQueue:
+    """A background job queue that merges jobs with the same key.
+
+    Submitting a key that is already waiting only bumps its count, so a burst of jobs for one key
+    is handled by a single call of handler(key, count). Keys are handled in the order they were
+    first submitted by one worker task, and at most max_keys keys wait at once; jobs for new keys
+    beyond that are dropped.
+    """
+
+    def __init__(self, name: str, handler, max_keys: int, max_count: int):
+        self.name = name
+        self.handler = handler
+        self.max_keys = max_keys
+        self.max_count = max_count
+        self.coalesced = 0
+        self.dropped = 0
+        self.processed = 0
+
+        self._pending = OrderedDict()  # key -> {"count", "enqueued_at"}, oldest first
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._task = None
+
+    def submit(self, key) -> bool:
+        """Queues a job for a key. Returns False if the queue is full and the job was dropped."""
+        entry = self._pending.get(key)
+        if entry is not None:
+            entry["count"] = min(self.max_count, entry["count"] + 1)
+            self.coalesced += 1
+            return True
+
+        if len(self._pending) >= self.max_keys:
+            self.dropped += 1
+            return False
+
+        self._pending[key] = {"count": 1, "enqueued_at": time.monotonic()}
+        self._wakeup.set()
+        return True
+
+    async def _run(self):
+        while True:
+            if not self._pending:
+                if self._stopping:
+                    return
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            key, entry = self._pending.popitem(last=False)
+            metrics.record_latency(f"{self.name}.lag", time.monotonic() - entry["enqueued_at"])
+            start = time.perf_counter()
+            try:
+                await self.handler(key, entry["count"])
+            except Exception as e:
+                print(f"Error in {self.name} job: {str(e)}")
+            self.processed += 1
+            metrics.record_latency(f"{self.name}.run", time.perf_counter() - start)
+
+    def start(self):
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = 5.0):
+        """Stops the worker, giving it up to timeout seconds to finish the jobs already queued."""
+        if self._task is None:
+            return
+        self._stopping = True
+        self._wakeup.set()
+        try:
+            await asyncio.wait_for(self._task, timeout)
+        except asyncio.TimeoutError:
+            print(f"{self.name} stopped with {len(self._pending)} jobs still queued")
+        self._task = None
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        oldest = next(iter(self._pending.values()), None)
+        return {
+            "queue_depth": len(self._pending),
+            "queued_jobs": sum(entry["count"] for entry in self._pending.values()),
+            "oldest_lag": now - oldest["enqueued_at"] if oldest else 0.0,
+            "processed": self.processed,
+            "coalesced": self.coalesced,
+            "dropped": self.dropped,
+        }
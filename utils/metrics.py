@@ -0,0 +1,49 @@
+import threading
+from collections import deque
+
+WINDOW_SIZE = 1000
+
+_latencies = {}
+_counters = {}
+_lock = threading.Lock()
+
+
+def record_latency(name: str, seconds: float):
+    """Records a latency sample, keeping the most recent WINDOW_SIZE samples per name."""
+    with _lock:
+        _latencies.setdefault(name, deque(maxlen=WINDOW_SIZE)).append(seconds)
+
+
+def increment(name: str, amount: float = 1):
+    """Adds to a running counter."""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+def counters() -> dict:
+    with _lock:
+        return dict(_counters)
+
+
+def _percentile(samples: list[float], percentile: float) -> float:
+    return samples[min(len(samples) - 1, int(len(samples) * percentile / 100))]
+
+
+def latency_summary() -> dict:
+    """Summarizes the recorded latencies.
+
+    Returns:
+        A dictionary mapping each name to its sample count and p50/p90/p99 latency in seconds.
+    """
+    with _lock:
+        windows = {name: sorted(samples) for name, samples in _latencies.items()}
+
+    return {
+        name: {
+            "count": len(samples),
+            "p50": _percentile(samples, 50),
+            "p90": _percentile(samples, 90),
+            "p99": _percentile(samples, 99),
+        }
+        for name, samples in windows.items()
+    }
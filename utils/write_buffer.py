@@ -0,0 +1,167 @@
+import asyncio
+import time
+
+from pymongo.errors import BulkWriteError
+
+from utils import metrics
+
+
+class DiscardedError(ConnectionAbortedError):
+    """Raised to a writer whose document was discarded before it was written."""
+
+
+class WriteBuffer:
+    """A write-behind buffer that batches inserts into a collection.
+
+    Documents are collected and written with a single insert_many once max_batch of them are
+    waiting or max_delay seconds after the first one arrived, whichever comes first. Documents
+    must carry their _id already, so callers know it before the write happens. Until a document
+    is written it is returned by pending(), which is how readers still see their own writes.
+    """
+
+    def __init__(self, name: str, collection, max_batch: int, max_delay: float):
+        self.name = name
+        self.collection = collection
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.batches = 0
+        self.written = 0
+        self.failed = 0
+
+        self._pending = []  # (document, future or None), oldest first
+        self._writing = []  # the batch being written
+        self._written = None  # resolved once the batch being written is done
+        self._wakeup = asyncio.Event()
+        self._full = asyncio.Event()
+        self._stopping = False
+        self._task = None
+
+    def _enqueue(self, document: dict, future):
+        self._pending.append((document, future))
+        if len(self._pending) >= self.max_batch:
+            self._full.set()
+        self._wakeup.set()
+
+    async def add(self, document: dict):
+        """Queues a document without waiting for it to be written. Write errors are only logged."""
+        if self._task is None:
+            await self.collection.insert_one(document)
+            return
+        self._enqueue(document, None)
+
+    async def write(self, document: dict):
+        """Queues a document and waits until its batch has been written."""
+        if self._task is None:
+            await self.collection.insert_one(document)
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._enqueue(document, future)
+        await future
+
+    def pending(self, user_id: str) -> list[dict]:
+        """Returns the documents of a user that are queued or being written."""
+        return [document for document, _ in self._writing + self._pending if document["user_id"] == user_id]
+
+    async def discard(self, user_id: str):
+        """Drops the queued documents of a user, e.g. when their history is wiped.
+
+        Writers waiting on a dropped document get a DiscardedError. Documents of the user that are
+        already being written cannot be taken back, so this waits for their batch to land. A delete
+        issued afterwards removes them too.
+        """
+        kept = []
+        discarded = []
+        for document, future in self._pending:
+            (discarded if document["user_id"] == user_id else kept).append((document, future))
+        self._pending = kept
+        self._fail(discarded, DiscardedError(f"{self.name} discarded the document before it was written"))
+
+        if any(document["user_id"] == user_id for document, _ in self._writing):
+            await asyncio.shield(self._written)
+
+    @staticmethod
+    def _fail(entries: list, error: BaseException):
+        for _, future in entries:
+            if future is not None and not future.done():
+                future.set_exception(error)
+
+    async def _flush(self):
+        self._writing, self._pending = self._pending[:self.max_batch], self._pending[self.max_batch:]
+        self._written = asyncio.get_running_loop().create_future()
+        batch = self._writing
+        start = time.perf_counter()
+        failed = set()
+        try:
+            await self.collection.insert_many([document for document, _ in batch], ordered=False)
+        except BulkWriteError as e:
+            failed = {error["index"] for error in e.details.get("writeErrors", [])}
+            error = e
+        except Exception as e:
+            failed = set(range(len(batch)))
+            error = e
+        except asyncio.CancelledError:
+            self._fail(batch, ConnectionAbortedError(f"{self.name} stopped before the batch was confirmed written"))
+            raise
+        finally:
+            self._writing = []
+            self._written.set_result(None)
+
+        if failed:
+            print(f"Error in {self.name} batch: {len(failed)} of {len(batch)} documents not written: {str(error)}")
+        for i, (_, future) in enumerate(batch):
+            if future is None or future.done():
+                continue
+            if i in failed:
+                future.set_exception(error)
+            else:
+                future.set_result(None)
+
+        self.batches += 1
+        self.written += len(batch) - len(failed)
+        self.failed += len(failed)
+        metrics.record_latency(f"{self.name}.flush", time.perf_counter() - start)
+
+    async def _run(self):
+        while True:
+            if not self._pending:
+                if self._stopping:
+                    return
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            if len(self._pending) < self.max_batch and not self._stopping:
+                self._full.clear()
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.max_delay)
+                except asyncio.TimeoutError:
+                    pass
+            await self._flush()
+
+    def start(self):
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = 5.0):
+        """Stops the buffer, giving it up to timeout seconds to write the documents still queued."""
+        if self._task is None:
+            return
+        self._stopping = True
+        self._full.set()
+        self._wakeup.set()
+        try:
+            await asyncio.wait_for(self._task, timeout)
+        except asyncio.TimeoutError:
+            print(f"{self.name} stopped with {len(self._pending)} documents not written")
+            self._fail(self._pending, ConnectionAbortedError(f"{self.name} stopped before the document was written"))
+            self._pending = []
+        self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pending) + len(self._writing),
+            "batches": self.batches,
+            "written": self.written,
+            "failed": self.failed,
+            "average_batch": self.written / self.batches if self.batches else 0.0,
+        }